@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+"""
+Benchmark the probe loop and outage handling of network_check.py offline,
+using the fake backends in network_check_sim.py.
+
+For each target count, a NetworkMonitor is built around a ScriptedProber
+(rounds take no time, so only network_check's own work is measured), a
+fake traceroute and an in-process SMTP sink, and three things are timed:
+
+  round      per-round overhead: probe_addresses() plus process_results()
+             on a healthy network
+  detection  from every target going dark until check_connectivity()
+             returns False, and until the failure email reaches the relay
+  recovery   from every target coming back until the recovery email
+             reaches the relay
+
+Detection includes the retry rounds and --retry-interval sleeps, so it is
+run with --retry-interval 0 unless another value is given.
+
+Synopsis:
+  ./bench_sim.py [ --targets int [int ...] ] [ --rounds int ]
+                 [ --retry-count int ] [ --retry-interval int ] [ --json ]
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+import network_check
+import network_check_sim
+
+# How long to wait for a notification to reach the sink before giving up.
+NOTICE_TIMEOUT = 30
+
+
+def target_addresses(count):
+    """Return `count` distinct addresses in 10.0.0.0/8."""
+    return [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(1, count + 1)]
+
+
+def build_monitor(workdir, targets, sink, args):
+    """Return a NetworkMonitor and its ScriptedProber for one target count."""
+    prober = network_check_sim.ScriptedProber()
+    monitor = network_check.NetworkMonitor(
+        ['--addresses', *target_addresses(targets),
+         '--retry-count', str(args.retry_count),
+         '--retry-interval', str(args.retry_interval),
+         '--notify-state-file', os.path.join(workdir, f'state.{targets}'),
+         '--outbox-dir', os.path.join(workdir, f'outbox.{targets}'),
+         '--email-recipients', 'bench@localhost',
+         '--email-relay', sink.relay,
+         '--exec-on-fail', 'true',
+         '--traceroute-address', '192.0.2.1',
+         # Send the recovery notice on the first check that finds the
+         # link up, so that its latency is what gets measured.
+         '--recovery-hold', '0'],
+        prober=prober)
+    return monitor, prober
+
+
+def milliseconds(seconds):
+    """Round a duration in seconds to milliseconds, passing None through."""
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def time_rounds(monitor, rounds):
+    """Return the wall time of each of `rounds` healthy probe rounds."""
+    samples = []
+    for _ in range(rounds):
+        monitor.failed_ping = []
+        start = time.perf_counter()
+        monitor.probe_addresses()
+        monitor.process_results()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_targets(workdir, targets, sink, args):
+    """Time one target count and return its results in milliseconds."""
+    monitor, prober = build_monitor(workdir, targets, sink, args)
+    samples = time_rounds(monitor, args.rounds)
+
+    expected = len(sink.messages) + 1
+    prober.set_all(loss=1.0)
+    start = time.monotonic()
+    connected = monitor.check_connectivity()
+    detected = time.monotonic()
+    # act_on_failure prints every address's statistics.
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        monitor.act_on_failure()
+    failure_notice = sink.messages[-1][0] if sink.wait_for(expected, NOTICE_TIMEOUT) else None
+    assert not connected, "outage was not detected"
+
+    expected += 1
+    prober.set_all(loss=0.0)
+    recovery_start = time.monotonic()
+    monitor.check_connectivity()
+    monitor.check_recovery()
+    recovery_notice = sink.messages[-1][0] if sink.wait_for(expected, NOTICE_TIMEOUT) else None
+
+    return {
+        'round_median_ms': milliseconds(statistics.median(samples)),
+        'round_min_ms': milliseconds(min(samples)),
+        'round_per_target_us': round(statistics.median(samples) / targets * 1e6, 2),
+        'detection_ms': milliseconds(detected - start),
+        'failure_notice_ms': milliseconds(failure_notice and failure_notice - start),
+        'recovery_notice_ms': milliseconds(recovery_notice and recovery_notice - recovery_start),
+    }
+
+
+def main():
+    """Run the benchmark and print a report."""
+    parser = argparse.ArgumentParser(description="Benchmark network_check against fake backends")
+    parser.add_argument('--targets', type=int, nargs='+', default=[3, 100, 1000],
+                        help="Target counts to benchmark")
+    parser.add_argument('--rounds', type=int, default=20,
+                        help="Healthy rounds timed per target count")
+    parser.add_argument('--retry-count', type=int, default=2,
+                        help="--retry-count given to network_check")
+    parser.add_argument('--retry-interval', type=int, default=0,
+                        help="--retry-interval given to network_check")
+    parser.add_argument('--json', action='store_true',
+                        help="Print the report as JSON instead of a table")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    report = {}
+    with tempfile.TemporaryDirectory() as workdir, network_check_sim.SmtpSink() as sink:
+        # The failure-hop check runs a fake traceroute whose hop 3 is silent.
+        network_check_sim.install_fake_traceroute(
+            workdir, network_check_sim.traceroute_output(
+                '192.0.2.1', ['192.168.1.1', '100.64.0.1'], silent_from=3))
+        os.environ['PATH'] = workdir + os.pathsep + os.environ['PATH']
+        for targets in args.targets:
+            report[targets] = bench_targets(workdir, targets, sink, args)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    columns = ('round_median_ms', 'round_min_ms', 'round_per_target_us', 'detection_ms',
+               'failure_notice_ms', 'recovery_notice_ms')
+    print(f"retry count {args.retry_count}, retry interval {args.retry_interval} s, "
+          f"{args.rounds} rounds per target count")
+    print(f"{'targets':>8} " + ' '.join(f"{column:>20}" for column in columns))
+    for targets, entry in report.items():
+        print(f"{targets:>8} " + ' '.join(f"{str(entry[column]):>20}" for column in columns))
+
+
+if __name__ == "__main__":
+    main()
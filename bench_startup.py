@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+"""
+Measure the cold-start cost of network_check.py so that regressions in
+import or initialisation time show up.
+
+Every sample runs in a fresh interpreter, as the systemd timer does.  The
+timer runs network_check.py as a script, whose bytecode is never cached, so
+the script is compiled from source every time rather than imported from
+__pycache__.  The report gives how long the bare interpreter takes to start,
+how long `network_check.py --help` takes end to end, and, for each prober
+backend, how long compiling the source, running the module body (top-level
+imports and definitions) and building NetworkMonitor() (argument parsing
+plus prober set-up) take.
+
+Synopsis:
+  ./bench_startup.py [ --runs int ] [ --json ]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Runs in the child interpreter and prints one JSON object of timings.
+SAMPLE = """
+import json, logging, sys, time, types
+t0 = time.perf_counter()
+with open('network_check.py', 'rb') as f:
+    code = compile(f.read(), 'network_check.py', 'exec')
+t1 = time.perf_counter()
+network_check = types.ModuleType('network_check')
+network_check.__file__ = 'network_check.py'
+sys.modules['network_check'] = network_check
+exec(code, network_check.__dict__)
+t2 = time.perf_counter()
+logging.disable(logging.CRITICAL)
+nm = network_check.NetworkMonitor(['--prober', sys.argv[1],
+                                   '--notify-state-file', '/nonexistent/state'])
+t3 = time.perf_counter()
+print(json.dumps({'compile': t1 - t0, 'exec': t2 - t1, 'init': t3 - t2,
+                  'prober': nm.prober.name, 'modules': len(sys.modules)}))
+"""
+
+
+def run_sample(prober):
+    """Run one timing sample in a fresh interpreter and return its results."""
+    result = subprocess.run([sys.executable, '-c', SAMPLE, prober],
+                            cwd=HERE, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+
+def interpreter_startup():
+    """Return the wall time of starting and stopping a bare interpreter."""
+    result = subprocess.run(
+        [sys.executable, '-c',
+         'import subprocess, sys, time\n'
+         't = time.perf_counter()\n'
+         'subprocess.run([sys.executable, "-c", "pass"], check=True)\n'
+         'print(time.perf_counter() - t)'],
+        capture_output=True, text=True, check=True)
+    return float(result.stdout)
+
+
+def script_help():
+    """Return the wall time of running `network_check.py --help` as a script."""
+    result = subprocess.run(
+        [sys.executable, '-c',
+         'import subprocess, sys, time\n'
+         't = time.perf_counter()\n'
+         'subprocess.run([sys.executable, "network_check.py", "--help"], check=True,\n'
+         '               stdout=subprocess.DEVNULL)\n'
+         'print(time.perf_counter() - t)'],
+        cwd=HERE, capture_output=True, text=True, check=True)
+    return float(result.stdout)
+
+
+def summarise(samples):
+    """Return median and minimum of a list of timings, in milliseconds."""
+    return {'median_ms': round(statistics.median(samples) * 1000, 2),
+            'min_ms': round(min(samples) * 1000, 2)}
+
+
+def main():
+    """Collect the samples and print a report."""
+    parser = argparse.ArgumentParser(description="Benchmark network_check start-up time")
+    parser.add_argument('--runs', type=int, default=20,
+                        help="Number of fresh interpreters to time per measurement")
+    parser.add_argument('--json', action='store_true',
+                        help="Print the report as JSON instead of a table")
+    args = parser.parse_args()
+
+    report = {'python': sys.version.split()[0],
+              'interpreter': summarise([interpreter_startup() for _ in range(args.runs)]),
+              'script_help': summarise([script_help() for _ in range(args.runs)])}
+    for prober in ('icmp', 'pingparsing'):
+        samples = [run_sample(prober) for _ in range(args.runs)]
+        report[prober] = {
+            'prober_used': samples[-1]['prober'],
+            'modules_loaded': samples[-1]['modules'],
+            'compile': summarise([sample['compile'] for sample in samples]),
+            'exec': summarise([sample['exec'] for sample in samples]),
+            'init': summarise([sample['init'] for sample in samples]),
+        }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"Python {report['python']}, {args.runs} runs per measurement")
+    print(f"{'measurement':<30} {'median ms':>10} {'min ms':>10}")
+    print(f"{'interpreter start-up':<30} {report['interpreter']['median_ms']:>10} "
+          f"{report['interpreter']['min_ms']:>10}")
+    print(f"{'network_check.py --help':<30} {report['script_help']['median_ms']:>10} "
+          f"{report['script_help']['min_ms']:>10}")
+    for prober in ('icmp', 'pingparsing'):
+        entry = report[prober]
+        label = f"--prober {prober} (used {entry['prober_used']})"
+        print(label)
+        for phase in ('compile', 'exec', 'init'):
+            print(f"  {phase:<28} {entry[phase]['median_ms']:>10} {entry[phase]['min_ms']:>10}")
+        print(f"  {'modules loaded':<28} {entry['modules_loaded']:>10}")
+
+
+if __name__ == "__main__":
+    main()
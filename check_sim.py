@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+"""
+Check the tcp: and dns: probing of network_check.py's IcmpProber against
+the local stand-in servers in network_check_sim.py.
+
+Each check runs a short round against a TcpService or DnsResponder in a
+given condition (answering, refusing, silent, slow, answering with the
+wrong query identifier) and compares the sent and received counts with
+what the condition should give.  Early-decided rounds are checked not to
+count requests still in flight as lost, and a prober built without an ICMP
+socket is checked to open one when it is asked to ping.
+
+Synopsis:
+  ./check_sim.py [ --count int ] [ --timeout float ]
+
+Exits with status 1 if any check fails.
+"""
+
+import argparse
+import logging
+import sys
+
+import network_check
+import network_check_sim
+
+LOG = logging.getLogger('check_sim')
+
+
+def probe(target, args, rule=None, icmp=False):
+    """Return (sent, received) from one round of args.count requests to target."""
+    prober = network_check.IcmpProber(LOG, interval=args.interval, timeout=args.timeout,
+                                      icmp=icmp)
+    try:
+        stats = prober.probe([target], args.count, rule)[target]
+    finally:
+        prober.close()
+    return stats['packet_transmit'], stats['packet_receive']
+
+
+def check_tcp(args):
+    """Yield (check, got, expected) for a listening and a closed TCP port."""
+    with network_check_sim.TcpService() as service:
+        yield 'tcp answering', probe(service.target, args), (args.count, args.count)
+        service.close()
+        yield 'tcp refused', probe(service.target, args), (args.count, 0)
+
+
+def check_dns(args):
+    """Yield (check, got, expected) for a DNS server in each condition."""
+    with network_check_sim.DnsResponder() as responder:
+        yield 'dns answering', probe(responder.target, args), (args.count, args.count)
+        responder.wrong_id = True
+        yield 'dns wrong id', probe(responder.target, args), (args.count, 0)
+        responder.wrong_id = False
+        responder.answering = False
+        yield 'dns silent', probe(responder.target, args), (args.count, 0)
+    with network_check_sim.DnsResponder(delay=args.timeout * 2) as responder:
+        yield 'dns too slow', probe(responder.target, args), (args.count, 0)
+    with network_check_sim.DnsResponder() as responder:
+        responder.close()
+        # The port unreachable reply is reported as a refused connection.
+        yield 'dns closed', probe(responder.target, args), (args.count, 0)
+
+
+def check_early_decision(args):
+    """Yield (check, got, expected) for a round a QuorumRule ends early, in
+    which every request answered or still in flight must count as received."""
+    with network_check_sim.TcpService() as service:
+        sent, received = probe(service.target, args, rule=network_check.QuorumRule())
+        yield 'early decision', (sent, received), (received, received)
+
+
+def check_lazy_icmp(args):
+    """Yield (check, got, expected) for an echo round on a prober built
+    without an ICMP socket, if this host allows one to be opened."""
+    try:
+        network_check.IcmpProber(LOG).close()
+    except OSError as e:
+        print(f"{'lazy icmp socket':<20} skipped: {e}")
+        return
+    yield 'lazy icmp socket', probe('127.0.0.1', args), (args.count, args.count)
+
+
+def main():
+    """Run every check and report the results."""
+    parser = argparse.ArgumentParser(description="Check tcp: and dns: probing against "
+                                                 "local stand-in servers")
+    parser.add_argument('--count', type=int, default=5,
+                        help="Requests sent per check")
+    parser.add_argument('--timeout', type=float, default=0.3,
+                        help="Seconds to wait for each reply")
+    args = parser.parse_args()
+    args.interval = args.timeout / 4
+
+    failed = 0
+    for checks in (check_tcp, check_dns, check_early_decision, check_lazy_icmp):
+        for name, got, expected in checks(args):
+            result = 'ok' if got == expected else 'FAILED'
+            failed += result != 'ok'
+            print(f"{name:<20} sent/received {got[0]}/{got[1]}, "
+                  f"expected {expected[0]}/{expected[1]}: {result}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
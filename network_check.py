@@ -8,100 +8,2644 @@ notifications are rate-limited independently of how frequently the script
 is scheduled to run.  A recovery email is sent when connectivity returns.
 
 Synopsis:
-  ./network_check.py --addresses a.b.c.d[,...]
+  ./network_check.py --addresses target [target ...] | --groups-file /path/to/groups.json
                    [ --retry-interval int ]
                    [ --retry-count int ]
+                   [ --concurrency int ]
+                   [ --prober icmp|pingparsing ]
+                   [ --probe-rate float ]
+                   [ --early-decision ]
+                   [ --retry-watch [ --retry-watch-interval seconds ] ]
+                   [ --adaptive-pings [ --min-pings int ] [ --jitter-threshold ms ] ]
+                   [ --detect-degradation [ --degradation-window int ]
+                     [ --degraded-loss percent ] [ --degraded-rtt ms ]
+                     [ --notify-degraded ] ]
                    [ --exec-on-fail /path/to/script ]
                    [ --email-recipients addr [addr ...] ]
                    [ --email-relay host ]
+                   [ --outbox-dir /path/to/spool ]
+                   [ --metrics-port int ]
+                   [ --metrics-textfile /path/to/file.prom ]
                    [ --notify-state-file /path/to/state ]
                    [ --notify-cooldown int ]
+                   [ --recovery-hold int ]
                    [ --reboot-cooldown int ]
                    [ --traceroute-address a.b.c.d ]
                    [ --reboot-hop-threshold int ]
+                   [ --gateway a.b.c.d ] [ --tiered ]
+                   [ --daemon [ --daemon-interval int ] ]
+                   [ --history-file /path/to/history [ --history-size int ] ]
+                   [ --history-query seconds ]
+                   [ --log-file /path/to/log [ --log-max-bytes int | --log-rotate-when when ]
+                     [ --log-backups int ] ]
+                   [ --log-format text|json ]
+                   [ --record /path/to/recording | --replay /path/to/recording ]
+                   [ --profile ] [ --profile-trace /path/to/trace.json ]
 """
 
 import argparse
-from email.message import EmailMessage
+import atexit
+import bisect
+import collections
+import contextlib
+import errno
 import json
 import logging
+import logging.handlers
+import math
+import mmap
 import os
 import pprint
-import smtplib
+import queue
+import select
+import selectors
+import shutil
+import signal
 import socket
+import struct
 import subprocess
 import sys
+import threading
 import time
+import warnings
 
-import pingparsing
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Formats each record as one compact JSON object: time, level, logger,
+    process and message, plus the FIELDS, which are null unless passed to
+    the logging call in `extra`.
+    """
+
+    # address: the target; sent/received: pings; loss: percent; rtt: average
+    # in ms; loop: the retry loop of the check; phase: as in --profile.
+    FIELDS = ('address', 'sent', 'received', 'loss', 'rtt', 'loop', 'phase')
+
+    def format(self, record):
+        entry = {'time': round(record.created, 3), 'level': record.levelname,
+                 'logger': record.name, 'pid': record.process, 'message': record.getMessage()}
+        for field in self.FIELDS:
+            entry[field] = getattr(record, field, None)
+        return json.dumps(entry, separators=(',', ':'))
 
 
 class Logger:
-    """Thin wrapper around the standard logging module providing a pre-configured
-    logger with a consistent format, optionally writing to a log file."""
+    """
+    Thin wrapper around the standard logging module providing a pre-configured
+    logger with a consistent format, optionally writing to a log file.
+
+    Records are put on a queue by the logging thread and written to stderr
+    and the file by a background thread, so that a slow SD card never holds
+    up probing.  The file is rotated once it reaches `rotate` bytes or, if
+    `rotate` is a string, at the interval it names (the `when` of
+    TimedRotatingFileHandler), keeping `backups` old files; with rotate=0 it
+    is never rotated.  With json_lines, records are written by
+    JsonLinesFormatter.  Getting a logger that has already been set up
+    replaces its handlers rather than adding to them.
+    """
 
-    def __init__(self, name, filename=None):
+    # (queue handler, listener) of each logger name set up so far.
+    configured = {}
+
+    def __init__(self, name, filename=None, rotate=0, backups=0, json_lines=False):
         self.logger_name = name
 
         if filename:
             self.filename = filename
         else:
             self.filename = None
+        self.rotate = rotate
+        self.backups = backups
+        self.json_lines = json_lines
+
+    def get_logger(self):
+        """Build and return the configured logger instance.  Raises OSError
+        if the log file cannot be opened."""
+        logger = logging.getLogger(self.logger_name)
+        logger.setLevel(logging.DEBUG)
+        if self.json_lines:
+            formatter = JsonLinesFormatter()
+        else:
+            formatter = logging.Formatter(
+                '%(asctime)s - %(levelname)s-%(name)s-[%(process)d] %(message)s')
+        handler = logging.StreamHandler()
+        handler.setLevel(logging.DEBUG)
+        handlers = [handler]
+        if self.filename:
+            if isinstance(self.rotate, str):
+                handlers.append(logging.handlers.TimedRotatingFileHandler(
+                    self.filename, when=self.rotate, backupCount=self.backups,
+                    encoding='utf-8'))
+            else:
+                handlers.append(logging.handlers.RotatingFileHandler(
+                    self.filename, maxBytes=self.rotate, backupCount=self.backups,
+                    encoding='utf-8'))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        if self.logger_name in Logger.configured:
+            queue_handler, listener = Logger.configured.pop(self.logger_name)
+            logger.removeHandler(queue_handler)
+            atexit.unregister(listener.stop)
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+        records = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(records)
+        logger.addHandler(queue_handler)
+        listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+        listener.start()
+        # Write out whatever is still queued when the process exits.
+        atexit.register(listener.stop)
+        Logger.configured[self.logger_name] = (queue_handler, listener)
+        return logger
+
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+# Seconds to wait for the reply to an echo request before counting it lost.
+ICMP_REPLY_TIMEOUT = 2.0
+# Default DNS server port for dns: targets.
+DNS_PORT = 53
+
+# A host has failed when its packet loss (percent) reaches this value, and a
+# round has failed when this fraction of the hosts have failed.
+HOST_LOSS_THRESHOLD = 50
+FAILED_HOST_QUORUM = 0.5
+# Consecutive --retry-watch pings that must show every target group up
+# before the link is taken to have recovered.
+RETRY_WATCH_CONFIRM = 2
+
+# A reboot is followed by pinging the gateway and the failed group's
+# addresses every REBOOT_PROBE_INTERVAL seconds, each ping timing out after
+# REBOOT_REPLY_TIMEOUT, until the group is up or REBOOT_TRACK_TIMEOUT
+# seconds after the fail script was started, after which the internet-up
+# time is left to the next check that finds the link up.
+REBOOT_PROBE_INTERVAL = 0.5
+REBOOT_REPLY_TIMEOUT = 1.0
+REBOOT_TRACK_TIMEOUT = 600
+# Seconds a recovery waits for reboots still being followed, so that their
+# results make it into the recovery email, and that a oneshot run waits
+# beyond REBOOT_TRACK_TIMEOUT for a reboot's result to be recorded.
+REBOOT_SETTLE_TIMEOUT = 10
+# Reboot results kept in the outage state.
+REBOOT_HISTORY_SIZE = 50
+
+# Name of the single target group used when --groups-file is not given.
+DEFAULT_GROUP = 'default'
+
+# Weight of the newest round in each address's moving average of loss, for
+# --detect-degradation.
+DEGRADATION_EWMA_ALPHA = 0.3
+
+# Probe history file layout: a header, a table of address slots, then a ring
+# of fixed-width records.  Header: magic, capacity in records, and the total
+# number of records ever written (the next write goes to total % capacity).
+HISTORY_MAGIC = b'NCHIST01'
+HISTORY_HEADER = struct.Struct('<8sIQ')
+HISTORY_ADDRESS_SLOT = 64
+HISTORY_ADDRESS_SLOTS = 256
+# Record: timestamp, address index, packets sent, packets received, and RTT
+# min/avg/max/mdev in milliseconds (NaN when there were no replies).
+HISTORY_RECORD = struct.Struct('<dHHH2xffff')
+# Minimum seconds between explicit flushes of the history file to disk.
+HISTORY_FLUSH_INTERVAL = 300
+
+TRACEROUTE_MAX_HOPS = 10
+TRACEROUTE_TIMEOUT = 120
+# Pings sent to each cached known-good hop when locating a failure.
+KNOWN_HOP_PINGS = 3
+
+# Seconds before an SMTP connection attempt or command is abandoned.
+SMTP_TIMEOUT = 10
+# Seconds between attempts to deliver spooled email while the relay is down.
+OUTBOX_RETRY_INTERVAL = 60
+# Seconds a oneshot run waits for the outbox to be delivered before exiting.
+OUTBOX_DRAIN_TIMEOUT = 15
+
+# Histogram bucket upper bounds, in seconds, for the exported metrics.
+RTT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+ROUND_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0, 60.0, 120.0)
+REBOOT_BUCKETS = (15.0, 30.0, 60.0, 90.0, 120.0, 180.0, 240.0, 300.0, 450.0, 600.0)
+
+# Per-address fields kept by --record, as in the probe history file.
+REPLAY_FIELDS = ('packet_transmit', 'packet_receive', 'rtt_min', 'rtt_avg', 'rtt_max', 'rtt_mdev')
+# A recorded traceroute is only replayed for a failure within this many
+# seconds of when it was run.
+REPLAY_TRACE_WINDOW = 3600
+
+# Trace events kept by --profile-trace; a long daemon run keeps only the first.
+PROFILE_MAX_EVENTS = 100000
+
+
+def parse_target(address):
+    """
+    Split a target into (protocol, host, port).  A bare IPv4 address is
+    pinged over ICMP; 'tcp:host:port' is probed by opening a TCP connection
+    and 'dns:host[:port]' by sending a DNS query over UDP.  The port is None
+    for ICMP.  Raises ValueError if the target is malformed.
+    """
+    protocol, _, rest = address.partition(':')
+    if not rest:
+        return 'icmp', address, None
+    host, _, port = rest.partition(':')
+    if protocol == 'dns' and not port:
+        return 'dns', host, DNS_PORT
+    if protocol not in ('tcp', 'dns') or not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f"expected a.b.c.d, tcp:a.b.c.d:port or dns:a.b.c.d[:port], "
+                         f"not {address}")
+    return protocol, host, int(port)
+
+
+def socket_targets(addresses):
+    """Return the tcp: and dns: targets among the addresses."""
+    return [address for address in addresses if parse_target(address)[0] != 'icmp']
+
+
+def dns_query(query_id):
+    """Return a DNS query for the root zone's NS records, which any resolver
+    can answer, with the given 16-bit identifier and recursion desired."""
+    return struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + b'\x00' + struct.pack('!HH', 2, 1)
+
+
+def icmp_checksum(data):
+    """Return the RFC 1071 internet checksum of the given bytes."""
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+class ProbeTally:
+    """
+    Running count of the echo requests sent to, and replies received from,
+    a single address during one probe round of `count` requests.
+
+    An adaptive tally starts with a count below max_count and is raised to
+    max_count as soon as a request is lost or two consecutive replies differ
+    by more than jitter_threshold milliseconds.
+    """
+
+    def __init__(self, address, count, max_count=None, jitter_threshold=None):
+        self.address = address
+        self.count = count
+        self.max_count = count if max_count is None else max_count
+        self.jitter_threshold = jitter_threshold
+        self.sent = 0
+        self.lost = 0
+        self.rtts = []
+        self.duplicates = 0
+
+    def add_reply(self, rtt):
+        """Record a reply, escalating the count if it shows jitter."""
+        if (self.jitter_threshold is not None and self.rtts
+                and abs(rtt - self.rtts[-1]) > self.jitter_threshold):
+            self.count = self.max_count
+        self.rtts.append(rtt)
+
+    def add_loss(self):
+        """Record a lost request and escalate the count."""
+        self.lost += 1
+        self.count = self.max_count
+
+    def due(self):
+        """Return True if more requests should be sent to this address."""
+        return self.sent < self.count
+
+    def reachable(self, loss_threshold):
+        """
+        Return False once this host is certain to reach loss_threshold percent
+        loss by the end of the round, True once it is certain not to, and None
+        while the remaining requests could still tip it either way.
+        """
+        if self.lost * 100 >= loss_threshold * self.count:
+            return False
+        # Certain even if the count is still escalated to max_count.
+        if (self.max_count - len(self.rtts)) * 100 < loss_threshold * self.max_count:
+            return True
+        # Every request answered without escalating: the count is final.
+        if len(self.rtts) == self.count:
+            return True
+        return None
+
+    @classmethod
+    def from_replies(cls, address, replies):
+        """Return the tally of a finished round given the RTT of each
+        request in order, or None for each request that was lost."""
+        tally = cls(address, len(replies))
+        tally.sent = len(replies)
+        for rtt in replies:
+            if rtt is None:
+                tally.add_loss()
+            else:
+                tally.add_reply(rtt)
+        return tally
+
+    def as_stats(self):
+        """
+        Summarise the tally in the same shape as pingparsing's
+        PingStats.as_dict(), which is what process_results consumes.  RTTs are
+        in milliseconds; loss and RTT fields are None when nothing was sent or
+        nothing came back, exactly as pingparsing reports them.
+        """
+        received = len(self.rtts)
+        stats = {
+            'destination': self.address,
+            'packet_transmit': self.sent,
+            'packet_receive': received,
+            'packet_loss_count': self.sent - received,
+            'packet_loss_rate': None,
+            'rtt_min': None,
+            'rtt_avg': None,
+            'rtt_max': None,
+            'rtt_mdev': None,
+            'packet_duplicate_count': self.duplicates,
+            'packet_duplicate_rate': None,
+        }
+        if self.sent:
+            stats['packet_loss_rate'] = (self.sent - received) * 100.0 / self.sent
+        if received:
+            avg = sum(self.rtts) / received
+            variance = sum(rtt * rtt for rtt in self.rtts) / received - avg * avg
+            stats['rtt_min'] = round(min(self.rtts), 3)
+            stats['rtt_avg'] = round(avg, 3)
+            stats['rtt_max'] = round(max(self.rtts), 3)
+            stats['rtt_mdev'] = round(math.sqrt(max(variance, 0.0)), 3)
+            stats['packet_duplicate_rate'] = self.duplicates * 100.0 / received
+        return stats
+
+
+class QuorumRule:
+    """
+    Incremental form of the process_results / sleep_if_failed decision.  Given
+    the tallies of a round in progress, outcome() reports 'down' once enough
+    hosts are certain to fail that the round must be retried, 'up' once too
+    few hosts can still fail for that to happen, and None until then.  If
+    addresses are given, only their tallies are considered.
+    """
+
+    def __init__(self, loss_threshold=HOST_LOSS_THRESHOLD, quorum=FAILED_HOST_QUORUM,
+                 addresses=None):
+        self.loss_threshold = loss_threshold
+        self.quorum = quorum
+        self.addresses = addresses
+        self.decided = None
+
+    def outcome(self, tallies):
+        """Return 'up', 'down' or None for the given {address: ProbeTally}."""
+        if self.addresses is None:
+            considered = list(tallies.values())
+        else:
+            considered = [tallies[address] for address in self.addresses]
+        reachable = unreachable = 0
+        for tally in considered:
+            verdict = tally.reachable(self.loss_threshold)
+            if verdict is True:
+                reachable += 1
+            elif verdict is False:
+                unreachable += 1
+        if unreachable / len(considered) >= self.quorum:
+            self.decided = 'down'
+        elif (len(considered) - reachable) / len(considered) < self.quorum:
+            self.decided = 'up'
+        return self.decided
+
+
+class TargetGroup:
+    """
+    A set of addresses judged together, typically those reached through one
+    upstream link.  The group is down when at least `quorum` of its addresses
+    lose at least loss_threshold percent of their pings, and fail_script, if
+    set, is the command run when it is.  Without --groups-file, every
+    --addresses address is in a single group named DEFAULT_GROUP.
+    """
+
+    # Settings a group may have in the --groups-file, besides its addresses.
+    SETTINGS = ('quorum', 'loss_threshold', 'exec_on_fail')
+
+    def __init__(self, name, addresses, quorum=FAILED_HOST_QUORUM,
+                 loss_threshold=HOST_LOSS_THRESHOLD, fail_script=None):
+        self.name = name
+        self.addresses = addresses
+        self.quorum = quorum
+        self.loss_threshold = loss_threshold
+        self.fail_script = fail_script
+
+    @classmethod
+    def load(cls, path, fail_script=None):
+        """
+        Read a list of groups from a JSON file mapping each group name to its
+        "addresses" and, optionally, "quorum" (fraction of the group),
+        "loss_threshold" (percent) and "exec_on_fail".  A group without
+        "exec_on_fail" uses fail_script; null disables the action for that
+        group.  Raises ValueError if the file is malformed.
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        if not isinstance(config, dict) or not config:
+            raise ValueError("expected an object mapping group names to groups")
+        groups = []
+        for name, entry in config.items():
+            if not isinstance(entry, dict):
+                raise ValueError(f"group '{name}' is not an object")
+            unknown = set(entry) - {'addresses', *cls.SETTINGS}
+            if unknown:
+                raise ValueError(f"group '{name}' has unknown settings: "
+                                 f"{', '.join(sorted(unknown))}")
+            addresses = entry.get('addresses')
+            if (not isinstance(addresses, list) or not addresses
+                    or not all(isinstance(address, str) for address in addresses)):
+                raise ValueError(f"group '{name}' needs a non-empty list of addresses")
+            quorum = entry.get('quorum', FAILED_HOST_QUORUM)
+            loss_threshold = entry.get('loss_threshold', HOST_LOSS_THRESHOLD)
+            if not isinstance(quorum, (int, float)) or not 0 < quorum <= 1:
+                raise ValueError(f"group '{name}' quorum must be > 0 and <= 1")
+            if not isinstance(loss_threshold, (int, float)) or not 0 < loss_threshold <= 100:
+                raise ValueError(f"group '{name}' loss_threshold must be > 0 and <= 100")
+            script = entry.get('exec_on_fail', fail_script)
+            if script is not None and not isinstance(script, str):
+                raise ValueError(f"group '{name}' exec_on_fail must be a string or null")
+            groups.append(cls(name, list(dict.fromkeys(addresses)), quorum,
+                              loss_threshold, script))
+        return groups
+
+    def failed_addresses(self, results):
+        """Return the group's addresses whose loss in {address: stats} reaches
+        the loss threshold, or which sent nothing at all."""
+        failed = []
+        for address in self.addresses:
+            loss = results[address]['packet_loss_rate']
+            if loss is None or loss >= self.loss_threshold:
+                failed.append(address)
+        return failed
+
+    def is_down(self, failed):
+        """Return True if the failed addresses make up a quorum of the group."""
+        return len(failed) / len(self.addresses) >= self.quorum
+
+    def is_up(self, replies, depth=RETRY_WATCH_CONFIRM):
+        """
+        Return True if the group is not down judged on the last `depth`
+        replies to each of its addresses ({address: [RTT or None, ...]}), nor
+        on the last RETRY_WATCH_CONFIRM of them.  Returns False if it is down
+        on either, or if any address has fewer than `depth` replies.  A deep
+        window is judged against the loss threshold like a full round, so a
+        lossy link that happens to answer a couple of pings is not up.
+        """
+        if any(len(replies[address]) < depth for address in self.addresses):
+            return False
+        for window in sorted({depth, RETRY_WATCH_CONFIRM}):
+            stats = {address: ProbeTally.from_replies(
+                address, list(replies[address])[-window:]).as_stats()
+                     for address in self.addresses}
+            if self.is_down(self.failed_addresses(stats)):
+                return False
+        return True
+
+    def rule(self):
+        """Return a QuorumRule deciding this group from a round in progress."""
+        return QuorumRule(self.loss_threshold, self.quorum, self.addresses)
+
+
+class GroupRule:
+    """
+    Combined QuorumRule for every target group probed in one round.  The
+    round's outcome is certain once every group's is: 'down' if any group is
+    down, otherwise 'up'.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.decided = None
+
+    def outcome(self, tallies):
+        """Return 'up', 'down' or None for the given {address: ProbeTally}."""
+        # A group's outcome never changes once certain, so stop asking.
+        outcomes = [rule.decided or rule.outcome(tallies) for rule in self.rules]
+        if None not in outcomes:
+            self.decided = 'down' if 'down' in outcomes else 'up'
+        return self.decided
+
+
+class ProbeScheduler:
+    """
+    Adaptive probe budget.  An address whose last round was clean (no loss
+    and RTT mdev within jitter_threshold) starts the next round with only
+    min_pings requests; any other address gets the full count.  A reduced
+    round is escalated to the full count by its ProbeTally as soon as loss
+    or jitter shows up, so a failing host is still judged on every ping.
+
+    Each address's record is kept in memory, and seeded from the probe
+    history file when there is one, so oneshot runs benefit too.
+    """
+
+    def __init__(self, min_pings, jitter_threshold, history=None):
+        self.min_pings = min_pings
+        self.jitter_threshold = jitter_threshold
+        self.history = history
+        self.clean = {}
+
+    def tally(self, address, count):
+        """Return the ProbeTally to start an address's round with."""
+        if address not in self.clean and self.history is not None:
+            record = self.history.latest(address)
+            if record is not None:
+                self.clean[address] = self.is_clean(record)
+        initial = min(self.min_pings, count) if self.clean.get(address) else count
+        return ProbeTally(address, initial, count, self.jitter_threshold)
+
+    def is_clean(self, stats):
+        """Return True if a round's stats show no loss and little jitter."""
+        sent = stats['packet_transmit']
+        if not sent or stats['packet_receive'] < sent:
+            return False
+        return (stats['rtt_mdev'] or 0) <= self.jitter_threshold
+
+    def observe(self, results):
+        """Update each address's record from a round's {address: stats}."""
+        for address, stats in results.items():
+            self.clean[address] = self.is_clean(stats)
+
+
+class DegradationDetector:
+    """
+    Rolling window of the last `window` rounds of every address's results,
+    used to spot a link that is getting worse before it fails outright.
+
+    Each round's individual reply RTTs are kept in one NumPy array of shape
+    (window, addresses, samples per round), with NaN where there was no
+    reply, and an exponentially weighted moving average of each address's
+    loss is updated as rounds arrive.  analyse() then works out RTT
+    percentiles and jitter (mean difference between consecutive replies)
+    for every address at once.  NumPy is imported here, so constructing a
+    detector raises ImportError when it is not installed.
+
+    When a probe history file is configured, the window is seeded from it so
+    that oneshot runs see more than their own rounds.  History only records
+    a summary of each round, so seeded rounds contribute their loss and
+    average RTT but nothing to jitter.
+    """
+
+    def __init__(self, addresses, window, samples, history=None):
+        import numpy  # pylint: disable=import-outside-toplevel
+        self.np = numpy
+        self.addresses = list(addresses)
+        self.index = {address: i for i, address in enumerate(self.addresses)}
+        self.window = window
+        self.rtts = numpy.full((window, len(self.addresses), samples), numpy.nan,
+                               dtype=numpy.float32)
+        self.loss_ewma = numpy.full(len(self.addresses), numpy.nan)
+        self.rounds = 0
+        if history is not None:
+            self.seed(history)
+
+    def seed(self, history):
+        """Replay the last `window` rounds recorded in a ProbeHistory."""
+        rounds = collections.deque(maxlen=self.window)
+        for record in history.query():
+            if not rounds or rounds[-1][0] != record['time']:
+                rounds.append((record['time'], {}, {}))
+            _, results, rtts = rounds[-1]
+            results[record['address']] = record
+            if record['rtt_avg'] is not None:
+                rtts[record['address']] = [record['rtt_avg']]
+        for _, results, rtts in rounds:
+            self.observe(results, rtts)
+
+    def observe(self, results, rtts):
+        """Add a round's {address: stats} and {address: [RTT ms]} to the window."""
+        np = self.np
+        slot = self.rtts[self.rounds % self.window]
+        slot.fill(np.nan)
+        loss = np.full(len(self.addresses), np.nan)
+        for address, stats in results.items():
+            i = self.index.get(address)
+            if i is None:
+                continue
+            if stats['packet_transmit']:
+                loss[i] = 1.0 - stats['packet_receive'] / stats['packet_transmit']
+            samples = rtts.get(address, [])[:slot.shape[1]]
+            slot[i, :len(samples)] = samples
+        seen = ~np.isnan(loss)
+        first = seen & np.isnan(self.loss_ewma)
+        self.loss_ewma[first] = loss[first]
+        update = seen & ~first
+        self.loss_ewma[update] += DEGRADATION_EWMA_ALPHA * (loss[update] - self.loss_ewma[update])
+        self.rounds += 1
+
+    def analyse(self, loss_threshold, rtt_threshold, jitter_threshold):
+        """
+        Return a dict of per-address arrays, in the order of `addresses`:
+        'loss_ewma' (fraction), 'rtt_p50', 'rtt_p95' and 'jitter' (ms, NaN
+        with no replies), and 'degraded', True where the EWMA loss reaches
+        loss_threshold percent, the 95th percentile RTT reaches
+        rtt_threshold ms, or the jitter reaches jitter_threshold ms.
+        """
+        np = self.np
+        # Oldest round first, so that consecutive samples are in time order.
+        ordered = np.roll(self.rtts, -(self.rounds % self.window), axis=0)
+        samples = ordered.transpose(1, 0, 2).reshape(len(self.addresses), -1)
+        with warnings.catch_warnings():
+            # Addresses with no replies in the window come out as NaN.
+            warnings.simplefilter('ignore', RuntimeWarning)
+            rtt_p50, rtt_p95 = np.nanpercentile(samples, [50, 95], axis=1)
+            jitter = np.nanmean(np.abs(np.diff(samples, axis=1)), axis=1)
+        with np.errstate(invalid='ignore'):
+            degraded = ((self.loss_ewma * 100 >= loss_threshold)
+                        | (rtt_p95 >= rtt_threshold) | (jitter >= jitter_threshold))
+        return {'loss_ewma': self.loss_ewma.copy(), 'rtt_p50': rtt_p50, 'rtt_p95': rtt_p95,
+                'jitter': jitter, 'degraded': degraded}
+
+
+class DegradationWatch:
+    """
+    Raises and clears the degraded state from a DegradationDetector's
+    analysis, with the --degraded-loss, --degraded-rtt and
+    --jitter-threshold thresholds.  A target group is degraded when its
+    quorum of addresses are.  The state is kept in a file next to the outage
+    state file, so that it is logged once when raised and once when cleared,
+    and notifications are rate-limited, across oneshot runs too.
+    """
+
+    def __init__(self, detector, args, log):
+        self.detector = detector
+        self.thresholds = (args.degraded_loss, args.degraded_rtt, args.jitter_threshold)
+        self.notify = args.notify_degraded
+        self.path = args.notify_state_file + '.degraded'
+        self.log = log
+
+    def analyse(self, groups):
+        """Return the detector's report and the names of the degraded target
+        groups."""
+        report = self.detector.analyse(*self.thresholds)
+        degraded = {address for address, flag in zip(self.detector.addresses, report['degraded'])
+                    if flag}
+        names = [group.name for group in groups
+                 if group.is_down([a for a in group.addresses if a in degraded])]
+        return report, names
+
+    def describe(self, report):
+        """Return a line of statistics for each degraded address."""
+        details = []
+        for i, address in enumerate(self.detector.addresses):
+            if report['degraded'][i]:
+                details.append(f"{address} loss {report['loss_ewma'][i] * 100:.0f}% "
+                               f"rtt p50/p95 {report['rtt_p50'][i]:.1f}/"
+                               f"{report['rtt_p95'][i]:.1f} ms "
+                               f"jitter {report['jitter'][i]:.1f} ms")
+        return details
+
+    def update(self, report, groups, now):
+        """
+        Raise or clear the degraded state for the names of the degraded
+        groups, and return it, or None once it has cleared.  The caller
+        saves a returned state with save().
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = None
+        if not groups:
+            if state is not None:
+                self.log.info("Link degradation has cleared.")
+                try:
+                    os.remove(self.path)
+                except OSError as e:
+                    self.log.error(f"Could not remove {self.path}: {e}")
+            return None
+        if state is None:
+            self.log.warning(f"Link degraded ({', '.join(groups)}): "
+                             f"{'; '.join(self.describe(report))}")
+            state = {'since': now, 'last_notify_time': None}
+        state['groups'] = groups
+        return state
+
+    def save(self, state):
+        """Persist the degraded state."""
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+        except OSError as e:
+            self.log.error(f"Could not write {self.path}: {e}")
+
+
+class EchoRound:
+    """State of one IcmpProber round: a tally per address, the requests still
+    awaiting a reply (in send order, keyed by sequence number for echo
+    requests and by socket for TCP and DNS probes), and the echo requests
+    already answered, used to spot duplicate replies."""
+
+    def __init__(self, addresses, count, rule=None, scheduler=None):
+        if scheduler is None:
+            self.tallies = {address: ProbeTally(address, count) for address in addresses}
+        else:
+            self.tallies = {address: scheduler.tally(address, count) for address in addresses}
+        self.rule = rule
+        self.pending = {}
+        self.answered = {}
+
+    def record_reply(self, source, seq, received_at):
+        """Match an echo reply against the outstanding requests."""
+        if seq in self.pending and self.pending[seq][0] == source:
+            address, sent_at = self.pending.pop(seq)
+            self.tallies[address].add_reply((received_at - sent_at) * 1000.0)
+            self.answered[seq] = address
+        elif self.answered.get(seq) == source:
+            self.tallies[source].duplicates += 1
+
+    def record_answer(self, key, received_at, answered):
+        """Settle the TCP or DNS probe with the given key, counting it as a
+        reply if it was answered and as lost otherwise."""
+        address, sent_at = self.pending.pop(key)
+        if answered:
+            self.tallies[address].add_reply((received_at - sent_at) * 1000.0)
+        else:
+            self.tallies[address].add_loss()
+
+    def expire(self, cutoff):
+        """Count requests sent before the cutoff time as lost, and return
+        their keys."""
+        expired = []
+        while self.pending:
+            key, (address, sent_at) = next(iter(self.pending.items()))
+            if sent_at > cutoff:
+                break
+            del self.pending[key]
+            self.tallies[address].add_loss()
+            expired.append(key)
+        return expired
+
+    def abandon(self):
+        """Forget the requests still awaiting a reply when the round ends
+        early, so that they count as neither sent nor lost, and return their
+        keys."""
+        abandoned = list(self.pending)
+        for address, _ in self.pending.values():
+            self.tallies[address].sent -= 1
+        self.pending.clear()
+        return abandoned
+
+    def due(self):
+        """Return the tallies that still have requests to send."""
+        return [tally for tally in self.tallies.values() if tally.due()]
+
+    def decided(self):
+        """Return True once the rule, if any, is certain of the outcome."""
+        return self.rule is not None and self.rule.outcome(self.tallies) is not None
+
+
+class PingparsingProber:
+    """Probe addresses by running the system ping command through
+    pingparsing, at most `concurrency` processes at a time."""
+
+    name = 'pingparsing'
+
+    def __init__(self, log, concurrency, interval=1.0, profiler=None):
+        self.log = log
+        self.concurrency = concurrency
+        self.interval = interval
+        self.profiler = profiler or PhaseProfiler(enabled=False)
+        # Imported here rather than at module load so that runs using the
+        # icmp prober never pay for pingparsing and its dependencies.
+        import concurrent.futures  # pylint: disable=import-outside-toplevel
+        import pingparsing  # pylint: disable=import-outside-toplevel
+        self.futures = concurrent.futures
+        self.pingparsing = pingparsing
+        self.ping_parse = pingparsing.PingParsing()
+        # Individual reply RTTs (ms) per address from the last probe() call.
+        self.last_rtts = {}
+
+    def probe(self, addresses, count, rule=None, scheduler=None):  # pylint: disable=unused-argument
+        """
+        Ping every address `count` times and return {address: stats}.  ping
+        only reports once it has finished, so neither a QuorumRule nor a
+        ProbeScheduler can change a round in progress; both are ignored.
+        """
+        results = {}
+        self.last_rtts = {}
+        with self.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = {pool.submit(self.ping_address, address, count): address
+                       for address in addresses}
+            for future in self.futures.as_completed(futures):
+                # Parsing stays on this thread; PingParsing keeps per-parse
+                # state on the instance and is not safe to share.
+                with self.profiler.phase('parse', futures[future]):
+                    result = self.ping_parse.parse(future.result())
+                results[futures[future]] = result.as_dict()
+                self.last_rtts[futures[future]] = [
+                    reply['time'] for reply in result.icmp_replies
+                    if reply.get('time') is not None and not reply.get('duplicate')]
+        return results
+
+    def ping_address(self, address, count):
+        """Ping a single address and return the raw transmitter result."""
+        self.log.info(f"Checking Address '{address}'", extra={'address': address})
+        ping_transmitter = self.pingparsing.PingTransmitter()
+        ping_transmitter.destination = address
+        ping_transmitter.count = count
+        if self.interval != 1.0:
+            ping_transmitter.ping_option = f"-i {self.interval}"
+        with self.profiler.phase('ping', address):
+            return ping_transmitter.ping()
+
+
+class IcmpProber:
+    """
+    Probe addresses in-process by sending ICMP echo requests to all of them
+    over a single socket, avoiding a ping fork/exec and text parsing per
+    address.  An unprivileged ICMP datagram socket is used where the kernel
+    allows it (net.ipv4.ping_group_range); otherwise a raw socket is opened,
+    which needs root or CAP_NET_RAW.  The constructor raises OSError if
+    neither kind of socket is available.
+
+    tcp: and dns: targets (see parse_target) are probed in the same loop,
+    each request on a socket of its own: a TCP probe is answered when the
+    connection is established, and a DNS probe when a response to its query
+    arrives.  Either way the RTT is measured from when the request was sent,
+    and a probe not answered within the timeout, or refused, is lost.  With
+    icmp=False the ICMP socket is only opened when the first echo request is
+    sent, and if it cannot be, every echo request is lost.
+    """
+
+    name = 'icmp'
+
+    def __init__(self, log, interval=1.0, timeout=ICMP_REPLY_TIMEOUT, ident=None, icmp=True):
+        self.log = log
+        self.interval = interval
+        self.timeout = timeout
+        # Probers open at the same time on raw sockets need their own
+        # identifiers to tell their replies apart.
+        self.ident = (os.getpid() if ident is None else ident) & 0xffff
+        self.seq = 0
+        # Individual reply RTTs (ms) per address from the last probe() call.
+        self.last_rtts = {}
+        # (protocol, host, port) of each address probed so far.
+        self.targets = {}
+        # Identifier of the query sent on each outstanding DNS probe's socket.
+        self.queries = {}
+        self.selector = selectors.DefaultSelector()
+        self.sock = None
+        self.raw = False
+        if icmp:
+            self._open_socket()
+
+    def _open_socket(self):
+        """Open the ICMP socket, raising OSError if neither kind is available."""
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        except OSError as e:
+            self.log.debug(f"ICMP datagram socket unavailable ({e}); trying a raw socket")
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self.raw = True
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
+    def close(self):
+        """Release the ICMP socket."""
+        self.selector.close()
+        if self.sock is not None:
+            self.sock.close()
+
+    def probe(self, addresses, count, rule=None, scheduler=None):
+        """
+        Send `count` echo requests to every address, one per address every
+        `interval` seconds, and return {address: stats} once every request
+        has been answered or has timed out.  If a QuorumRule is given, the
+        round stops as soon as its outcome is certain, and the stats cover
+        only the requests answered or timed out by then.  If a ProbeScheduler is
+        given, it decides how many requests each address starts with.
+        """
+        echo_round = EchoRound(addresses, count, rule, scheduler)
+        for address in addresses:
+            self.log.info(f"Checking Address '{address}'", extra={'address': address})
+
+        start = time.monotonic()
+        burst = 0
+        while echo_round.due():
+            if burst and self._collect_replies(echo_round, start + burst * self.interval):
+                break
+            for tally in echo_round.due():
+                self._send(echo_round, tally)
+            burst += 1
+            # Wait for the last replies.  A loss or jitter seen now can still
+            # escalate an adaptive tally, which makes it due again.
+            if not echo_round.due() and self._collect_replies(
+                    echo_round, time.monotonic() + self.timeout, until_idle=True):
+                break
+        # A round decided early leaves requests outstanding; they were neither
+        # answered nor lost, so the stats leave them out.
+        for key in echo_round.abandon():
+            if isinstance(key, socket.socket):
+                self._forget(key)
+        self.last_rtts = {address: tally.rtts for address, tally in echo_round.tallies.items()}
+        return {address: tally.as_stats() for address, tally in echo_round.tallies.items()}
+
+    def _send(self, echo_round, tally):
+        """Send one request of the right kind to the tally's address."""
+        target = self.targets.get(tally.address)
+        if target is None:
+            target = self.targets[tally.address] = parse_target(tally.address)
+        if target[0] == 'icmp':
+            self._send_echo(echo_round, tally)
+        else:
+            self._open_probe(echo_round, tally, *target)
+
+    def _open_probe(self, echo_round, tally, protocol, host, port):
+        """Start a TCP connection to, or send a DNS query to, host:port on a
+        new socket and remember it."""
+        tally.sent += 1
+        kind = socket.SOCK_STREAM if protocol == 'tcp' else socket.SOCK_DGRAM
+        sock = socket.socket(socket.AF_INET, kind)
+        sock.setblocking(False)
+        try:
+            if protocol == 'tcp':
+                error = sock.connect_ex((host, port))
+                if error not in (0, errno.EINPROGRESS):
+                    raise OSError(error, os.strerror(error))
+                events = selectors.EVENT_WRITE
+            else:
+                self.seq = (self.seq + 1) & 0xffff
+                sock.connect((host, port))
+                sock.send(dns_query(self.seq))
+                self.queries[sock] = self.seq
+                events = selectors.EVENT_READ
+            self.selector.register(sock, events)
+        except OSError as e:
+            # Count the request as sent and lost, as for an echo request.
+            self.log.debug(f"{protocol.upper()} probe to {tally.address} failed: {e}")
+            self.queries.pop(sock, None)
+            sock.close()
+            tally.add_loss()
+            return
+        echo_round.pending[sock] = (tally.address, time.monotonic())
+
+    def _settle_probe(self, echo_round, sock):
+        """Record the outcome of a TCP or DNS probe whose socket is ready."""
+        received_at = time.monotonic()
+        if sock in self.queries:
+            try:
+                data = sock.recv(512)
+            except OSError:
+                # An ICMP port unreachable comes back as a refused connection.
+                answered = False
+            else:
+                query_id, flags = struct.unpack('!HH', data[:4]) if len(data) >= 4 else (None, 0)
+                if query_id != self.queries[sock] or not flags & 0x8000:
+                    return
+                answered = True
+        else:
+            answered = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+        echo_round.record_answer(sock, received_at, answered)
+        self._forget(sock)
+
+    def _forget(self, sock):
+        """Close a TCP or DNS probe's socket."""
+        self.selector.unregister(sock)
+        self.queries.pop(sock, None)
+        sock.close()
+
+    def _send_echo(self, echo_round, tally):
+        """Send one echo request to the tally's address and remember it."""
+        self.seq = (self.seq + 1) & 0xffff
+        header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, self.ident, self.seq)
+        payload = b'network_check'.ljust(48, b'\x00')
+        checksum = icmp_checksum(header + payload)
+        packet = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum,
+                             self.ident, self.seq) + payload
+        tally.sent += 1
+        try:
+            if self.sock is None:
+                self._open_socket()
+            self.sock.sendto(packet, (tally.address, 0))
+        except OSError as e:
+            # Count the request as sent and lost, as ping would.
+            self.log.debug(f"Echo request to {tally.address} failed: {e}")
+            tally.add_loss()
+            return
+        echo_round.pending[self.seq] = (tally.address, time.monotonic())
+
+    def _collect_replies(self, echo_round, deadline, until_idle=False):
+        """
+        Read echo replies until the deadline passes, or, when until_idle is
+        set, until nothing is left outstanding or a tally has become due
+        again.  Returns True if the round's rule became certain of its
+        outcome, which ends the round early.
+        """
+        pending = echo_round.pending
+        while True:
+            for key in echo_round.expire(time.monotonic() - self.timeout):
+                if isinstance(key, socket.socket):
+                    self._forget(key)
+            if echo_round.decided():
+                return True
+            if until_idle and (not pending or echo_round.due()):
+                return False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if pending:
+                oldest = next(iter(pending.values()))[1]
+                remaining = min(remaining, oldest + self.timeout - time.monotonic())
+            for key, _ in self.selector.select(max(remaining, 0)):
+                if key.fileobj is self.sock:
+                    reply = self._read_reply()
+                    if reply is not None:
+                        echo_round.record_reply(*reply)
+                elif key.fileobj in pending:
+                    self._settle_probe(echo_round, key.fileobj)
+
+    def _read_reply(self):
+        """Return (source, seq, timestamp) for an echo reply meant for us, or
+        None for anything else arriving on the socket."""
+        try:
+            data, (source, _) = self.sock.recvfrom(1024)
+        except OSError:
+            return None
+        received_at = time.monotonic()
+        if self.raw:
+            # Raw sockets deliver the IP header too, and every ICMP packet
+            # on the host, so strip the header and match our identifier.
+            data = data[(data[0] & 0x0f) * 4:]
+        if len(data) < 8:
+            return None
+        icmp_type, _, _, ident, seq = struct.unpack('!BBHHH', data[:8])
+        if icmp_type != ICMP_ECHO_REPLY:
+            return None
+        # Datagram sockets have their identifier rewritten by the kernel,
+        # which also filters replies for us.
+        if self.raw and ident != self.ident:
+            return None
+        return source, seq, received_at
+
+
+class VirtualClock:
+    """
+    Stands in for the time module in --replay.  time() and monotonic() both
+    read a virtual time, which only sleep() moves on, at once.
+    """
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def time(self):
+        """Return the virtual time."""
+        return self.now
+
+    def monotonic(self):
+        """Return the virtual time."""
+        return self.now
+
+    def sleep(self, seconds):
+        """Move the virtual time on without waiting."""
+        self.now += max(0.0, seconds)
+
+
+def summary_stats(address, record):
+    """
+    Return stats in the shape ProbeTally.as_stats() gives from a record with
+    only the REPLAY_FIELDS, as kept by ProbeHistory and --record.  Missing
+    RTTs may be None or NaN.
+    """
+    sent = record['packet_transmit']
+    received = record['packet_receive']
+    stats = {
+        'destination': address,
+        'packet_transmit': sent,
+        'packet_receive': received,
+        'packet_loss_count': sent - received,
+        'packet_loss_rate': (sent - received) * 100.0 / sent if sent else None,
+        'packet_duplicate_count': 0,
+        'packet_duplicate_rate': 0.0 if received else None,
+    }
+    for key in REPLAY_FIELDS[2:]:
+        value = record[key]
+        stats[key] = None if value is None or math.isnan(value) else value
+    return stats
+
+
+class RecordingProber:
+    """
+    Wraps another prober for --record, appending every round it probes to a
+    JSON-lines file as {"time", "duration", "results": {address: [the
+    REPLAY_FIELDS]}}.  Pings outside the probe rounds, such as --retry-watch
+    pings and pings to known-good hops, are probed with a `kind`, which is
+    added to the entry so that a replay can tell them from rounds.
+    Traceroute output passed through record_traceroute() is appended as
+    {"time", "traceroute"}.  The constructor raises OSError if the file
+    cannot be opened.
+    """
+
+    def __init__(self, prober, path, log):
+        self.prober = prober
+        self.name = prober.name
+        self.log = log
+        # Line-buffered, so that a recording is complete up to the last round
+        # however the process ends.
+        self.file = open(path, 'a', encoding='utf-8',  # pylint: disable=consider-using-with
+                         buffering=1)
+
+    @property
+    def last_rtts(self):
+        """Individual reply RTTs (ms) per address from the last round."""
+        return self.prober.last_rtts
+
+    def probe(self, addresses, count, rule=None,  # pylint: disable=too-many-arguments
+              scheduler=None, kind=None):
+        """Probe with the wrapped prober and record the round, tagged with
+        `kind` if it is not a probe round."""
+        start = time.time()
+        results = self.prober.probe(addresses, count, rule, scheduler)
+        entry = {'time': round(start, 3), 'duration': round(time.time() - start, 3),
+                 'results': {address: [stats[key] for key in REPLAY_FIELDS]
+                             for address, stats in results.items()}}
+        if kind is not None:
+            entry['kind'] = kind
+        self.write(entry)
+        return results
+
+    def record_traceroute(self, lines):
+        """Yield the traceroute output lines, recording those read once the
+        caller stops reading."""
+        start = time.time()
+        seen = []
+        try:
+            for line in lines:
+                seen.append(line)
+                yield line
+        finally:
+            lines.close()
+            self.write({'time': round(start, 3), 'traceroute': '\n'.join(seen)})
+
+    def write(self, entry):
+        """Append one entry to the recording."""
+        try:
+            self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        except OSError as e:
+            self.log.error(f"Could not write to recording {self.file.name}: {e}")
+
+    def close(self):
+        """Close the recording and the wrapped prober."""
+        self.file.close()
+        if hasattr(self.prober, 'close'):
+            self.prober.close()
+
+
+def probe_aside(prober, kind, addresses, count):
+    """Ping the addresses outside a probe round.  A RecordingProber tags the
+    pings with `kind`, so that a replay does not take them for a round."""
+    if isinstance(prober, RecordingProber):
+        return prober.probe(addresses, count, kind=kind)
+    return prober.probe(addresses, count)
+
+
+class ReplayProber:
+    """
+    Prober for --replay that answers from a recording made with --record,
+    or from a probe history file, instead of the network.  A probe at a
+    given time of its VirtualClock gets, for each address, the latest round
+    recorded at or before then (or the first, before the recording starts),
+    and moves the clock on by the recorded round's duration scaled to count
+    pings, or by count pings at `interval` where that was not recorded.  A
+    probe of fewer pings than the round spreads the round's loss evenly over
+    the address's successive pings, so that --retry-watch sees the recorded
+    loss.  An address that was never recorded sends nothing.  Entries tagged
+    with a kind by RecordingProber are not rounds and are skipped.  The
+    constructor raises OSError or ValueError if the recording cannot be read.
+    """
+
+    name = 'replay'
+
+    def __init__(self, path, clock, interval=1.0):
+        self.clock = clock
+        self.interval = interval
+        # Per address, the times of its recorded rounds and, at the same
+        # index, (record, duration).
+        self.times = {}
+        self.rounds = {}
+        # Recorded traceroutes as (time, output), oldest first.
+        self.traces = []
+        self.first = self.last = None
+        self.last_rtts = {}
+        # Pings given so far to each address from short probes.
+        self.spread = {}
+        with open(path, 'rb') as f:
+            is_history = f.read(len(HISTORY_MAGIC)) == HISTORY_MAGIC
+        if is_history:
+            self._load_history(path)
+        else:
+            self._load_recording(path)
+        if self.first is None:
+            raise ValueError("no probe rounds recorded")
+
+    def _add(self, timestamp, address, record, duration):
+        """Keep one address's result from a round recorded at timestamp."""
+        self.times.setdefault(address, []).append(timestamp)
+        self.rounds.setdefault(address, []).append((record, duration))
+        if self.first is None or timestamp < self.first:
+            self.first = timestamp
+        if self.last is None or timestamp > self.last:
+            self.last = timestamp
+
+    def _load_recording(self, path):
+        """Read a JSON-lines recording made with --record."""
+        with open(path, 'r', encoding='utf-8') as f:
+            for number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                    if 'traceroute' in entry:
+                        self.traces.append((entry['time'], entry['traceroute']))
+                        continue
+                    if 'kind' in entry:
+                        continue
+                    for address, values in entry['results'].items():
+                        self._add(entry['time'], address, dict(zip(REPLAY_FIELDS, values)),
+                                  entry.get('duration'))
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    raise ValueError(f"line {number} is not a recorded round or "
+                                     f"traceroute: {e}") from e
+        self.traces.sort(key=lambda trace: trace[0])
+
+    def _load_history(self, path):
+        """Read every record of a probe history file."""
+        history = ProbeHistory(path)
+        try:
+            for record in history.query():
+                if record['address'] is not None:
+                    self._add(record['time'], record['address'], record, None)
+        finally:
+            history.close()
+
+    def span(self):
+        """Return the times of the first and last recorded rounds."""
+        return self.first, self.last
+
+    def probe_at(self, address, timestamp):
+        """Return the address's stats from the round in effect at the
+        timestamp, without moving the clock on."""
+        found = self.result_at(address, timestamp)
+        if found is None:
+            return ProbeTally(address, 0).as_stats()
+        return summary_stats(address, found[0])
+
+    def result_at(self, address, timestamp):
+        """Return (record, duration) of the address's round in effect at the
+        timestamp, or None if it was never recorded."""
+        times = self.times.get(address)
+        if times is None:
+            return None
+        return self.rounds[address][max(0, bisect.bisect_right(times, timestamp) - 1)]
+
+    def probe(self, addresses, count, rule=None, scheduler=None):  # pylint: disable=unused-argument
+        """
+        Return {address: stats} from the rounds in effect now, in the same
+        shape as the real probers.  Recorded rounds cannot be cut short or
+        extended, so a QuorumRule or ProbeScheduler is ignored.
+        """
+        now = self.clock.time()
+        results = {}
+        self.last_rtts = {}
+        duration = None
+        for address in addresses:
+            found = self.result_at(address, now)
+            if found is None:
+                results[address] = ProbeTally(address, count).as_stats()
+                self.last_rtts[address] = []
+                continue
+            record, recorded_duration = found
+            stats = summary_stats(address, record)
+            sent = stats['packet_transmit']
+            if count < sent:
+                stats = self._spread(address, stats, count)
+            results[address] = stats
+            # Only the average RTT is recorded; it stands in for every reply.
+            self.last_rtts[address] = [stats['rtt_avg']] * stats['packet_receive']
+            if duration is None and recorded_duration is not None and sent:
+                duration = recorded_duration * count / sent
+        self.clock.sleep(duration if duration is not None else count * self.interval)
+        return results
+
+    def _spread(self, address, stats, count):
+        """Return stats for `count` pings to the address that carry on the
+        even spread of the recorded round's loss from its earlier pings."""
+        loss = stats['packet_loss_count'] / stats['packet_transmit']
+        tally = ProbeTally(address, count)
+        tally.sent = count
+        start = self.spread.get(address, 0)
+        for seq in range(start, start + count):
+            # Ping seq is lost when the running share of losses crosses a
+            # whole number, as in the simulator's scripted prober.
+            if math.floor((seq + 1) * loss) != math.floor(seq * loss):
+                tally.add_loss()
+            else:
+                tally.add_reply(stats['rtt_avg'])
+        self.spread[address] = start + count
+        return tally.as_stats()
+
+    def traceroute_at(self, timestamp):
+        """Return the output of the last traceroute recorded within
+        REPLAY_TRACE_WINDOW seconds before the timestamp, or None."""
+        index = bisect.bisect_right([trace[0] for trace in self.traces], timestamp)
+        if index and timestamp - self.traces[index - 1][0] <= REPLAY_TRACE_WINDOW:
+            return self.traces[index - 1][1]
+        return None
+
+
+class ProbeHistory:
+    """
+    Ring buffer of per-address probe results kept in a fixed-size,
+    memory-mapped file.  Appending a round only rewrites the records for that
+    round and the header in place, so the file never grows and each round
+    dirties a page or two.  Explicit flushes are limited to one every
+    HISTORY_FLUSH_INTERVAL seconds to keep SD-card writes bounded; the kernel
+    writes the remaining dirty pages back on its own schedule.
+
+    If capacity is None an existing history file is opened at whatever size
+    it was created with, which is what readers want.  Otherwise the file is
+    created, or re-created if it was made with a different capacity.
+    """
+
+    def __init__(self, path, capacity=None):
+        self.path = path
+        self.records_offset = HISTORY_HEADER.size + HISTORY_ADDRESS_SLOT * HISTORY_ADDRESS_SLOTS
+        fd = os.open(path, os.O_RDWR | (os.O_CREAT if capacity else 0), 0o644)
+        try:
+            existing = self._read_capacity(fd)
+            if capacity is None:
+                if existing is None:
+                    raise ValueError(f"{path} is not a probe history file")
+                capacity = existing
+            size = self.records_offset + HISTORY_RECORD.size * capacity
+            if existing != capacity or os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, HISTORY_HEADER.pack(HISTORY_MAGIC, capacity, 0), 0)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.capacity = capacity
+        self.addresses = self._read_addresses()
+        self.last_flush = time.monotonic()
+
+    @staticmethod
+    def _read_capacity(fd):
+        """Return the capacity recorded in a history file's header, or None
+        if the file is empty or not a history file."""
+        header = os.pread(fd, HISTORY_HEADER.size, 0)
+        if len(header) < HISTORY_HEADER.size:
+            return None
+        magic, capacity, _ = HISTORY_HEADER.unpack(header)
+        return capacity if magic == HISTORY_MAGIC else None
+
+    def _read_addresses(self):
+        """Load the address table from the file."""
+        addresses = []
+        for slot in range(HISTORY_ADDRESS_SLOTS):
+            start = HISTORY_HEADER.size + slot * HISTORY_ADDRESS_SLOT
+            name = self.map[start:start + HISTORY_ADDRESS_SLOT].rstrip(b'\x00')
+            if not name:
+                break
+            addresses.append(name.decode('utf-8'))
+        return addresses
+
+    def _address_index(self, address):
+        """Return the table index for an address, adding it if there is room,
+        or None if the table is full."""
+        if address in self.addresses:
+            return self.addresses.index(address)
+        if len(self.addresses) == HISTORY_ADDRESS_SLOTS:
+            return None
+        start = HISTORY_HEADER.size + len(self.addresses) * HISTORY_ADDRESS_SLOT
+        name = address.encode('utf-8')[:HISTORY_ADDRESS_SLOT]
+        self.map[start:start + HISTORY_ADDRESS_SLOT] = name.ljust(HISTORY_ADDRESS_SLOT, b'\x00')
+        self.addresses.append(address)
+        return len(self.addresses) - 1
+
+    def total(self):
+        """Return the number of records ever written to the file."""
+        return HISTORY_HEADER.unpack_from(self.map, 0)[2]
+
+    def _offset(self, position):
+        """Return the file offset of the record at an absolute position."""
+        return self.records_offset + (position % self.capacity) * HISTORY_RECORD.size
+
+    def append_round(self, timestamp, results):
+        """
+        Append one record per address from a probe round's {address: stats}.
+        Addresses that no longer fit in the address table are skipped.
+        """
+        total = self.total()
+        for address, stats in results.items():
+            index = self._address_index(address)
+            if index is None:
+                continue
+            rtts = [math.nan if stats[key] is None else stats[key]
+                    for key in ('rtt_min', 'rtt_avg', 'rtt_max', 'rtt_mdev')]
+            HISTORY_RECORD.pack_into(self.map, self._offset(total), timestamp, index,
+                                     min(stats['packet_transmit'], 0xffff),
+                                     min(stats['packet_receive'], 0xffff), *rtts)
+            total += 1
+        HISTORY_HEADER.pack_into(self.map, 0, HISTORY_MAGIC, self.capacity, total)
+        if time.monotonic() - self.last_flush >= HISTORY_FLUSH_INTERVAL:
+            self.flush()
+
+    def _record(self, position):
+        """Decode the record at an absolute position into a dict."""
+        timestamp, index, sent, received, *rtts = HISTORY_RECORD.unpack_from(
+            self.map, self._offset(position))
+        record = {
+            'time': timestamp,
+            'address': self.addresses[index] if index < len(self.addresses) else None,
+            'packet_transmit': sent,
+            'packet_receive': received,
+        }
+        for key, value in zip(('rtt_min', 'rtt_avg', 'rtt_max', 'rtt_mdev'), rtts):
+            record[key] = None if math.isnan(value) else round(value, 3)
+        return record
+
+    def latest(self, address):
+        """
+        Return the most recent record for an address, or None.  Each round
+        writes one record per address, so only the last few rounds' worth of
+        records need to be searched.
+        """
+        if address not in self.addresses:
+            return None
+        total = self.total()
+        oldest = max(0, total - self.capacity, total - 4 * len(self.addresses))
+        for position in range(total - 1, oldest - 1, -1):
+            record = self._record(position)
+            if record['address'] == address:
+                return record
+        return None
+
+    def query(self, start=None, end=None):
+        """
+        Yield the records with start <= time <= end, oldest first.  Records
+        are stored in time order, so the window's start is found by binary
+        search.
+        """
+        total = self.total()
+        low, high = max(0, total - self.capacity), total
+        if start is not None:
+            while low < high:
+                middle = (low + high) // 2
+                if HISTORY_RECORD.unpack_from(self.map, self._offset(middle))[0] < start:
+                    low = middle + 1
+                else:
+                    high = middle
+        for position in range(low, total):
+            record = self._record(position)
+            if end is not None and record['time'] > end:
+                return
+            yield record
+
+    def flush(self):
+        """Write dirty pages of the history file to disk."""
+        self.map.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        """Flush and unmap the history file."""
+        self.flush()
+        self.map.close()
+
+
+class Outbox:
+    """
+    On-disk spool of outgoing email, delivered by a background thread.
+
+    enqueue() writes the message to the spool directory and returns at once.
+    The flusher thread delivers everything spooled over a single SMTP
+    connection, deleting each file once the relay has accepted it, and keeps
+    retrying every OUTBOX_RETRY_INTERVAL seconds while the relay cannot be
+    reached.  Spooled messages survive restarts and are picked up by the next
+    process that uses the same directory.
+
+    Only the newest undelivered message of each kind is kept, so a flapping
+    link that queues several failure and recovery notices while the relay
+    is down delivers at most one of each, in the order they last happened.
+    """
+
+    def __init__(self, directory, relay, log, profiler=None):
+        self.directory = directory
+        self.relay = relay
+        self.log = log
+        self.profiler = profiler or PhaseProfiler(enabled=False)
+        os.makedirs(directory, exist_ok=True)
+        self.wakeup = threading.Event()
+        self.attempted = threading.Condition()
+        self.attempts = 0
+        self.flushing = False
+        self.thread = None
+
+    def start(self):
+        """Start the background flusher, which first delivers anything left
+        in the spool by an earlier run."""
+        self.thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self.thread.start()
+
+    def pending(self, kind='*'):
+        """Return the spooled message files, oldest first."""
+        suffix = '.eml' if kind == '*' else f'-{kind}.eml'
+        return sorted(os.path.join(self.directory, name)
+                      for name in os.listdir(self.directory) if name.endswith(suffix))
+
+    def enqueue(self, kind, message):
+        """
+        Spool a message of the given kind ('failure', 'recovery', ...) and
+        wake the flusher.  An undelivered message of the same kind is
+        replaced, and the replacement's subject notes how many were merged.
+        """
+        coalesced = 0
+        # Imported on demand; email is only needed on failure or recovery.
+        from email.parser import BytesHeaderParser  # pylint: disable=import-outside-toplevel
+        for path in self.pending(kind):
+            try:
+                with open(path, 'rb') as f:
+                    coalesced += 1 + int(BytesHeaderParser().parse(f).get(
+                        'X-Network-Check-Coalesced', 0))
+                os.remove(path)
+            except (OSError, ValueError):
+                continue
+        if coalesced:
+            message['X-Network-Check-Coalesced'] = str(coalesced)
+            subject = message['Subject']
+            message.replace_header('Subject', f"{subject} (+{coalesced} earlier)")
+
+        path = os.path.join(self.directory, f"{time.time_ns()}-{kind}.eml")
+        with open(path + '.tmp', 'wb') as f:
+            f.write(message.as_bytes())
+        os.replace(path + '.tmp', path)
+        self.wakeup.set()
+
+    def flush(self):
+        """
+        Deliver every spooled message over one SMTP connection.  Returns True
+        if the spool was emptied, False if the relay could not be reached or
+        refused a message; whatever is left is retried later.
+        """
+        paths = self.pending()
+        if not paths:
+            return True
+        # Imported on demand; email is only needed on failure or recovery.
+        import email  # pylint: disable=import-outside-toplevel
+        import email.policy  # pylint: disable=import-outside-toplevel
+        import smtplib  # pylint: disable=import-outside-toplevel
+        try:
+            with self.profiler.phase('smtp', self.relay), \
+                    smtplib.SMTP(self.relay, timeout=SMTP_TIMEOUT) as smtp:
+                for path in paths:
+                    try:
+                        with open(path, 'rb') as f:
+                            message = email.message_from_binary_file(
+                                f, policy=email.policy.default)
+                    except FileNotFoundError:
+                        # Replaced by a newer message of the same kind.
+                        continue
+                    smtp.send_message(message)
+                    os.remove(path)
+                    self.log.info(f"Delivered {message['Subject']!r} via {self.relay}")
+        except (OSError, smtplib.SMTPException) as e:
+            self.log.warning(f"Could not deliver spooled email via {self.relay}: {e}; "
+                             f"retrying in {OUTBOX_RETRY_INTERVAL} seconds.")
+            return False
+        return True
+
+    def _run(self):
+        """Flusher thread: deliver on every wake-up and retry periodically."""
+        while True:
+            self.wakeup.clear()
+            with self.attempted:
+                self.flushing = True
+            try:
+                self.flush()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                # Never let a bad spool file kill the flusher.
+                self.log.error(f"Outbox flush failed: {e}")
+            with self.attempted:
+                self.flushing = False
+                self.attempts += 1
+                self.attempted.notify_all()
+            self.wakeup.wait(OUTBOX_RETRY_INTERVAL)
+
+    def drain(self, timeout):
+        """
+        Wait up to timeout seconds for a delivery attempt that covers
+        everything spooled so far.  Returns True if the spool is empty.
+        """
+        if self.thread is None:
+            return not self.pending()
+        with self.attempted:
+            # An attempt already in progress may predate the newest message.
+            target = self.attempts + (2 if self.flushing else 1)
+            self.wakeup.set()
+            self.attempted.wait_for(lambda: self.attempts >= target, timeout)
+        return not self.pending()
+
+
+class Notifier:
+    """
+    Sends the notification emails to the --email-recipients, through an
+    Outbox once open_outbox() has started one, or else straight to the
+    relay.  Without recipients nothing is sent.
+    """
+
+    def __init__(self, args, log, profiler):
+        self.emails = args.emails
+        self.relay = args.email_relay
+        self.outbox_dir = args.outbox_dir
+        self.log = log
+        self.profiler = profiler
+        self.outbox = None
+        self._hostname = None
+
+    @property
+    def hostname(self):
+        """
+        Fully-qualified hostname used in notification emails.  Resolved on
+        first use and cached, since getfqdn() can block on DNS for seconds
+        and is only needed once there is something to report.
+        """
+        if self._hostname is None:
+            try:
+                self._hostname = socket.getfqdn()
+            except OSError:
+                self.log.error("Unable to detect proper hostname")
+                self._hostname = socket.gethostname()
+        return self._hostname
+
+    def open_outbox(self):
+        """
+        Create the email outbox and start delivering anything already
+        spooled.  Nothing is opened when no recipients are configured, and
+        if the spool directory cannot be created, email is sent directly
+        instead.
+        """
+        if self.emails is None:
+            return
+        try:
+            outbox = Outbox(self.outbox_dir, self.relay, self.log, self.profiler)
+        except OSError as e:
+            self.log.error(f"Could not use outbox directory {self.outbox_dir}: {e}; "
+                           f"sending email directly.")
+            return
+        outbox.start()
+        self.outbox = outbox
+
+    def send(self, kind, tag, body):
+        """
+        Send an email of the given kind with `body` as its text and `tag` in
+        its subject.  Without an outbox the message is sent directly, and a
+        relay that cannot be reached is only logged.
+        """
+        if self.emails is None:
+            return
+
+        # Imported on demand; email is only needed when there is news.
+        from email.message import EmailMessage  # pylint: disable=import-outside-toplevel
+        message = EmailMessage()
+        message.set_content(body)
+        # Keeping a timestamp in the subject is important since this message
+        # may be getting delivered significantly later than the event it
+        # reports.  It waits in the outbox until the relay can be reached,
+        # which after a failure may not be until internet connectivity has
+        # been restored.
+        message['Subject'] = f"[{tag}] {time.strftime('%Y%m%d-%H%M%S')} - {self.hostname}"
+        message['From'] = f"network_check@{self.hostname}"
+        message['To'] = ', '.join(self.emails)
+
+        if self.outbox is not None:
+            try:
+                self.outbox.enqueue(kind, message)
+                return
+            except OSError as e:
+                self.log.error(f"Could not spool {kind} email: {e}; sending directly.")
+        import smtplib  # pylint: disable=import-outside-toplevel
+        try:
+            with self.profiler.phase('smtp', self.relay), \
+                    smtplib.SMTP(self.relay, timeout=SMTP_TIMEOUT) as smtp:
+                smtp.send_message(message)
+        except (OSError, smtplib.SMTPException) as e:
+            self.log.error(f"Could not send {kind} email via {self.relay}: {e}")
+
+    def drain(self):
+        """Give spooled email a bounded chance to go out before a oneshot run
+        exits; anything left is delivered by a later run."""
+        if self.outbox is not None and not self.outbox.drain(OUTBOX_DRAIN_TIMEOUT):
+            self.log.warning(f"Email still queued in {self.outbox_dir}; it will be "
+                             f"retried on the next run.")
+
+
+def default_gateway(path='/proc/net/route'):
+    """Return the IPv4 address of the default gateway from the kernel routing
+    table, or None if there is no default route or the table is unreadable."""
+    try:
+        with open(path, 'r', encoding='ascii') as f:
+            lines = f.readlines()[1:]
+    except OSError:
+        return None
+    for line in lines:
+        fields = line.split()
+        # Iface Destination Gateway Flags ...; RTF_GATEWAY is 0x2.
+        if len(fields) > 3 and fields[1] == '00000000' and int(fields[3], 16) & 0x2:
+            return socket.inet_ntoa(struct.pack('<L', int(fields[2], 16)))
+    return None
+
+
+def describe_reboot(outcome):
+    """Return a one-line summary of a reboot result from RebootExecutor."""
+    def seconds(key):
+        return 'not seen' if outcome[key] is None else f"{outcome[key]:.1f} s"
+    result = {True: 'recovered', False: 'not recovered',
+              None: 'awaiting the internet'}[outcome['recovered']]
+    return (f"Reboot {result}: fail script exit code {outcome['exit_code']}, "
+            f"modem up {seconds('modem_up_seconds')}, "
+            f"internet up {seconds('internet_up_seconds')}.")
+
+
+class RebootExecutor:
+    """
+    Runs fail scripts on background threads, so that a script which holds
+    the outlet off for its whole delay does not hold up the monitor, and
+    follows each reboot through to recovery.
+
+    While a group's script runs and afterwards, the gateway and the group's
+    addresses are each pinged every REBOOT_PROBE_INTERVAL seconds with a
+    prober of the reboot's own, made by prober_factory(n) for the n-th
+    reboot.  Once the script has exited (the power is back on), the first
+    reply from the gateway marks the modem as up, and the group being up
+    over RETRY_WATCH_CONFIRM consecutive pings marks the internet as up.
+    The outcome is passed to on_done as a dict: start time, group, gateway,
+    the script's exit code and run time, seconds from the start of the
+    reboot until the modem and the internet were up (None if they were
+    not), and whether the internet came back within REBOOT_TRACK_TIMEOUT:
+    True, or None if it was still not up then, in which case
+    NetworkMonitor.record_internet_up completes the result later.
+    """
+
+    def __init__(self, prober_factory, profiler):
+        self.prober_factory = prober_factory
+        self.profiler = profiler
+        self.lock = threading.Lock()
+        self.running = {}
+        self.started = 0
+
+    def busy(self, name):
+        """Return True if the named group's last reboot is still being followed."""
+        with self.lock:
+            thread = self.running.get(name)
+            return thread is not None and thread.is_alive()
+
+    def start(self, group, gateway, on_done):
+        """Run the group's fail script and follow the reboot on a new thread."""
+        with self.lock:
+            self.started += 1
+            prober = self.prober_factory(self.started)
+            thread = threading.Thread(target=self._run, args=(group, gateway, prober, on_done),
+                                      name=f"reboot-{group.name}", daemon=True)
+            self.running[group.name] = thread
+        thread.start()
+
+    def wait(self, timeout):
+        """Wait up to `timeout` seconds for every reboot to be resolved.
+        Returns True if none is still being followed."""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            threads = list(self.running.values())
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in threads)
+
+    def _run(self, group, gateway, prober, on_done):
+        """Thread body: run one group's fail script and follow the reboot."""
+        start = time.monotonic()
+        outcome = {'time': time.time(), 'group': group.name, 'gateway': gateway,
+                   'exit_code': None, 'script_seconds': None, 'modem_up_seconds': None,
+                   'internet_up_seconds': None, 'recovered': False}
+        replies = {address: collections.deque(maxlen=RETRY_WATCH_CONFIRM)
+                   for address in group.addresses}
+        with self.profiler.phase('reboot', group.name):
+            proc = subprocess.Popen(group.fail_script,  # pylint: disable=consider-using-with
+                                    shell=True)
+            while time.monotonic() - start < REBOOT_TRACK_TIMEOUT:
+                tick = time.monotonic()
+                if outcome['exit_code'] is None and proc.poll() is not None:
+                    outcome['exit_code'] = proc.returncode
+                    outcome['script_seconds'] = round(tick - start, 1)
+                targets = list(group.addresses)
+                if gateway is not None and outcome['modem_up_seconds'] is None:
+                    targets = list(dict.fromkeys(targets + [gateway]))
+                prober.probe(targets, 1)
+                if outcome['exit_code'] is not None:
+                    elapsed = round(time.monotonic() - start, 1)
+                    if gateway in targets and prober.last_rtts.get(gateway):
+                        outcome['modem_up_seconds'] = elapsed
+                    for address in group.addresses:
+                        replies[address].append((prober.last_rtts.get(address) or [None])[0])
+                    if group.is_up(replies):
+                        outcome['internet_up_seconds'] = elapsed
+                        outcome['recovered'] = True
+                        break
+                time.sleep(max(0.0, tick + REBOOT_PROBE_INTERVAL - time.monotonic()))
+            else:
+                outcome['recovered'] = None
+        if prober is not None and hasattr(prober, 'close'):
+            prober.close()
+        on_done(outcome)
+
+
+class Histogram:
+    """Cumulative histogram in the Prometheus style: a count per bucket
+    upper bound, plus the sum and count of all observations."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add one observation."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """Yield exposition lines for this histogram."""
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == math.inf else repr(bound)
+            yield f"{name}_bucket{format_labels(labels, le=le)} {cumulative}"
+        yield f"{name}_sum{format_labels(labels)} {self.sum!r}"
+        yield f"{name}_count{format_labels(labels)} {self.count}"
+
+
+def format_labels(labels, **extra):
+    """Format a label set for the Prometheus text exposition format."""
+    pairs = dict(labels, **extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"')
+               for value in pairs.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(pairs, escaped)) + '}'
+
+
+class Metrics:
+    """
+    Collects link-quality metrics as the monitor runs and renders them in the
+    Prometheus text exposition format, either served over HTTP or written to
+    `textfile` for node_exporter's textfile collector.  Counters and histograms
+    cover the lifetime of the process, so in oneshot mode they describe the
+    last run.  Cooldown timers are computed from the outage state when the
+    metrics are rendered.
+    """
+
+    def __init__(self, notify_cooldown, reboot_cooldown, textfile=None):
+        self.notify_cooldown = notify_cooldown
+        self.reboot_cooldown = reboot_cooldown
+        self.textfile = textfile
+        self.lock = threading.Lock()
+        self.rtt = {}
+        self.loss = {}
+        self.sent = {}
+        self.received = {}
+        self.round_duration = Histogram(ROUND_BUCKETS)
+        self.failure_hop = None
+        self.failure_hop_checks = 0
+        self.reboots = 0
+        self.reboot_results = {}
+        self.modem_up = Histogram(REBOOT_BUCKETS)
+        self.internet_up = Histogram(REBOOT_BUCKETS)
+        self.connected = None
+        self.last_check = None
+        self.state = None
+        self.group_up = {}
+        self.degradation = {}
+        self.degraded_groups = {}
+
+    def observe_round(self, results, rtts, duration):
+        """Record a probe round's {address: stats}, its individual reply
+        RTTs in milliseconds, and how long it took in seconds."""
+        with self.lock:
+            self.round_duration.observe(duration)
+            for address, stats in results.items():
+                histogram = self.rtt.setdefault(address, Histogram(RTT_BUCKETS))
+                for rtt in rtts.get(address, ()):
+                    histogram.observe(rtt / 1000.0)
+                if stats['packet_loss_rate'] is not None:
+                    self.loss[address] = stats['packet_loss_rate'] / 100.0
+                self.sent[address] = self.sent.get(address, 0) + stats['packet_transmit']
+                self.received[address] = (self.received.get(address, 0)
+                                          + stats['packet_receive'])
+
+    def observe_failure_hop(self, hop):
+        """Record the result of HopTracker.failure_hop (None if inconclusive)."""
+        with self.lock:
+            self.failure_hop = hop
+            self.failure_hop_checks += 1
+
+    def observe_groups(self, group_up):
+        """Record whether each target group was up in the last round."""
+        with self.lock:
+            self.group_up = dict(group_up)
+
+    def observe_degradation(self, addresses, report, degraded_groups, groups):
+        """Record the rolling-window statistics of each address and whether
+        each target group is degraded."""
+        keys = ('loss_ewma', 'rtt_p50', 'rtt_p95', 'jitter')
+        with self.lock:
+            self.degradation = {address: [float(report[key][i]) for key in keys]
+                                for i, address in enumerate(addresses)}
+            self.degraded_groups = {group: group in degraded_groups for group in groups}
+
+    def observe_reboot(self):
+        """Record that the fail script was run."""
+        with self.lock:
+            self.reboots += 1
+
+    def observe_reboot_result(self, outcome):
+        """Record how a reboot followed by RebootExecutor turned out."""
+        result = {True: 'recovered', False: 'not_recovered',
+                  None: 'awaiting_internet'}[outcome['recovered']]
+        with self.lock:
+            self.reboot_results[result] = self.reboot_results.get(result, 0) + 1
+            if outcome['modem_up_seconds'] is not None:
+                self.modem_up.observe(outcome['modem_up_seconds'])
+            if outcome['internet_up_seconds'] is not None:
+                self.internet_up.observe(outcome['internet_up_seconds'])
+
+    def observe_internet_up(self, outcome):
+        """Record the internet-up time of a reboot that was still awaiting
+        the internet when RebootExecutor stopped following it."""
+        with self.lock:
+            self.reboot_results['recovered'] = self.reboot_results.get('recovered', 0) + 1
+            self.internet_up.observe(outcome['internet_up_seconds'])
+
+    def observe_check(self, connected, state):
+        """Record the outcome of a connectivity check and the outage state
+        after it was handled (None once an outage is over)."""
+        with self.lock:
+            self.connected = connected
+            self.last_check = time.time()
+            self.state = dict(state) if state is not None else None
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+
+        with self.lock:
+            now = time.time()
+            metric('network_check_rtt_seconds', 'histogram', "Echo reply round-trip time.",
+                   [line for address, histogram in sorted(self.rtt.items())
+                    for line in histogram.samples('network_check_rtt_seconds',
+                                                  {'address': address})])
+            metric('network_check_packet_loss_ratio', 'gauge',
+                   "Packet loss in the last round.",
+                   [f"network_check_packet_loss_ratio{format_labels({'address': a})} {v!r}"
+                    for a, v in sorted(self.loss.items())])
+            metric('network_check_probes_sent_total', 'counter', "Echo requests sent.",
+                   [f"network_check_probes_sent_total{format_labels({'address': a})} {v}"
+                    for a, v in sorted(self.sent.items())])
+            metric('network_check_probes_received_total', 'counter', "Echo replies received.",
+                   [f"network_check_probes_received_total{format_labels({'address': a})} {v}"
+                    for a, v in sorted(self.received.items())])
+            metric('network_check_round_duration_seconds', 'histogram',
+                   "Duration of a probe round.",
+                   list(self.round_duration.samples('network_check_round_duration_seconds', {})))
+            if self.connected is not None:
+                metric('network_check_up', 'gauge',
+                       "1 if the last check confirmed connectivity, else 0.",
+                       [f"network_check_up {int(self.connected)}"])
+                metric('network_check_last_check_timestamp_seconds', 'gauge',
+                       "Time of the last completed check.",
+                       [f"network_check_last_check_timestamp_seconds {self.last_check!r}"])
+            if self.group_up:
+                metric('network_check_group_up', 'gauge',
+                       "1 if the target group was up in the last round, else 0.",
+                       [f"network_check_group_up{format_labels({'group': g})} {int(v)}"
+                        for g, v in sorted(self.group_up.items())])
+            if self.degradation:
+                for i, (name, help_text, scale) in enumerate((
+                        ('network_check_loss_ewma_ratio', "Moving average of packet loss.", 1),
+                        ('network_check_rtt_p50_seconds', "Median RTT over the window.", 1e-3),
+                        ('network_check_rtt_p95_seconds', "95th percentile RTT over the window.",
+                         1e-3),
+                        ('network_check_jitter_seconds', "Mean RTT change between replies.",
+                         1e-3))):
+                    metric(name, 'gauge', help_text,
+                           [f"{name}{format_labels({'address': a})} {v[i] * scale!r}"
+                            for a, v in sorted(self.degradation.items())
+                            if not math.isnan(v[i])])
+                metric('network_check_degraded', 'gauge',
+                       "1 if the target group is degraded, else 0.",
+                       [f"network_check_degraded{format_labels({'group': g})} {int(v)}"
+                        for g, v in sorted(self.degraded_groups.items())])
+            metric('network_check_failure_hop_checks_total', 'counter',
+                   "Failure-hop checks performed.",
+                   [f"network_check_failure_hop_checks_total {self.failure_hop_checks}"])
+            if self.failure_hop is not None:
+                metric('network_check_failure_hop', 'gauge',
+                       "First unresponsive hop found by the last failure-hop check.",
+                       [f"network_check_failure_hop {self.failure_hop}"])
+            metric('network_check_reboots_total', 'counter', "Times the fail script was run.",
+                   [f"network_check_reboots_total {self.reboots}"])
+            if self.reboot_results:
+                metric('network_check_reboot_results_total', 'counter',
+                       "Reboots followed to the end, by whether the internet came back.",
+                       [f"network_check_reboot_results_total{format_labels({'result': r})} {v}"
+                        for r, v in sorted(self.reboot_results.items())])
+                metric('network_check_reboot_modem_up_seconds', 'histogram',
+                       "Time from the start of a reboot until the gateway answered.",
+                       list(self.modem_up.samples('network_check_reboot_modem_up_seconds', {})))
+                metric('network_check_reboot_internet_up_seconds', 'histogram',
+                       "Time from the start of a reboot until the target group was up.",
+                       list(self.internet_up.samples('network_check_reboot_internet_up_seconds',
+                                                     {})))
+            metric('network_check_outage_active', 'gauge', "1 while an outage is recorded.",
+                   [f"network_check_outage_active {int(self.state is not None)}"])
+            if self.state is not None:
+                metric('network_check_outage_reboots', 'gauge',
+                       "Modem reboots during the current outage.",
+                       [f"network_check_outage_reboots {self.state['reboot_count']}"])
+                metric('network_check_outage_duration_seconds', 'gauge',
+                       "Time since the current outage was first detected.",
+                       [f"network_check_outage_duration_seconds "
+                        f"{now - self.state['first_failure_time']!r}"])
+                for name, key, cooldown in (('reboot', 'last_reboot_time', self.reboot_cooldown),
+                                            ('notify', 'last_notify_time', self.notify_cooldown)):
+                    last = self.state[key]
+                    remaining = 0.0 if last is None else max(0.0, cooldown - (now - last))
+                    metric(f'network_check_{name}_cooldown_remaining_seconds', 'gauge',
+                           f"Seconds until the next {name} is allowed.",
+                           [f"network_check_{name}_cooldown_remaining_seconds {remaining!r}"])
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """Atomically write the metrics to a file for a textfile collector."""
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(path + '.tmp', path)
+
+    def serve(self, port):
+        """Serve the metrics at http://<host>:port/metrics from a background
+        thread and return the server."""
+        import http.server  # pylint: disable=import-outside-toplevel
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """Answers GET /metrics with the rendered metrics."""
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """Serve the metrics page."""
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """Keep scrapes out of the log."""
+
+        server = http.server.ThreadingHTTPServer(('', port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+
+class PhaseProfiler:
+    """
+    Wall-clock and CPU time spent in each phase of a run, per target.
+
+    Wrap a phase in `with profiler.phase('name', target):` to time it.  CPU
+    time is that of the calling thread only, so time spent in child processes
+    such as ping, traceroute or the fail script shows up as wall time with
+    little CPU.  Every timed phase is also kept as an event in Chrome's trace
+    format (chrome://tracing, Perfetto) for write_trace(), to trace_path if
+    one is given.  A disabled profiler times nothing and costs next to
+    nothing.
+    """
+
+    def __init__(self, enabled=True, trace_path=None):
+        self.enabled = enabled
+        self.trace_path = trace_path
+        self.lock = threading.Lock()
+        # (phase, target) -> [calls, wall seconds, CPU seconds, longest wall seconds]
+        self.totals = {}
+        self.events = []
+        self.origin = time.perf_counter()
+
+    def phase(self, name, target=None):
+        """Return a context manager timing one occurrence of a phase."""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timed(name, target)
+
+    @contextlib.contextmanager
+    def _timed(self, name, target):
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.thread_time() - cpu_start
+            with self.lock:
+                entry = self.totals.setdefault((name, target), [0, 0.0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += wall
+                entry[2] += cpu
+                entry[3] = max(entry[3], wall)
+                if len(self.events) < PROFILE_MAX_EVENTS:
+                    args = {'cpu_ms': round(cpu * 1000, 3)}
+                    if target is not None:
+                        args['target'] = target
+                    self.events.append({
+                        'name': name, 'ph': 'X', 'pid': os.getpid(),
+                        'tid': threading.get_ident(),
+                        'ts': round((wall_start - self.origin) * 1e6, 1),
+                        'dur': round(wall * 1e6, 1), 'args': args})
+
+    def summary(self):
+        """Return the totals as a table, slowest phase first."""
+        lines = [f"{'phase':<20} {'target':<24} {'calls':>6} {'wall s':>10} "
+                 f"{'cpu s':>10} {'max s':>10}"]
+        with self.lock:
+            rows = sorted(self.totals.items(), key=lambda item: -item[1][1])
+        for (name, target), (calls, wall, cpu, longest) in rows:
+            lines.append(f"{name:<20} {target or '-':<24} {calls:>6} {wall:>10.3f} "
+                         f"{cpu:>10.3f} {longest:>10.3f}")
+        lines.append(f"{'total run time':<45} {time.perf_counter() - self.origin:>17.3f}")
+        return '\n'.join(lines)
+
+    def write_trace(self, path):
+        """Write the recorded phases to `path` as a Chrome trace JSON file."""
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class HopTracker:
+    """
+    Works out how far along the path out of the network a confirmed failure
+    lies, for the reboot decision.  With --tiered the nearest routers are
+    pinged ahead of the addresses every round and the first of them not to
+    answer is the failure hop.  Otherwise, on failure, the routers cached
+    from an earlier traceroute are pinged or a traceroute to the
+    --traceroute-address is followed.
+
+    The routers for hops 1..reboot_hop_threshold are cached here, so that a
+    daemon remembers them between outages, and in the outage state passed
+    in, so that oneshot runs do.
+    """
+
+    def __init__(self, args, prober, log, profiler):
+        self.prober = prober
+        self.log = log
+        self.profiler = profiler
+        self.traceroute_address = args.traceroute_address
+        self.reboot_hop_threshold = args.reboot_hop_threshold
+        self.gateway = args.gateway
+        self.tiered = args.tiered
+        # First-responding router for each hop up to reboot_hop_threshold,
+        # from the last traceroute that got past them.
+        self.known_good_hops = None
+        # With --tiered, the routers pinged ahead of the targets in the last
+        # round, nearest first, and the hop number of the first of them that
+        # did not answer (None if they all did).
+        self.tier_hops = []
+        self.tier_failure_hop = None
+        # Whether each gateway pinged as the only tier has answered pings in
+        # this process (True), or has been silent without ever answering.
+        self.gateway_answered = {}
+
+    def gateway_address(self):
+        """Return --gateway, or the default route's gateway, or None if
+        there is neither."""
+        return self.gateway if self.gateway is not None else default_gateway()
+
+    def local_hops(self, state):
+        """
+        Return the routers between here and the addresses that --tiered pings
+        first, nearest first: those cached from an earlier traceroute if
+        there are any, here or in the outage state (which may be None),
+        otherwise the gateway (--gateway or the default route).
+        """
+        hops = self.cached_hops(state)
+        if hops:
+            return list(hops)
+        gateway = self.gateway_address()
+        return [] if gateway is None else [gateway]
+
+    def cached_hops(self, state):
+        """Return the routers cached from a traceroute, here or in the outage
+        state (which may be None), or None."""
+        hops = self.known_good_hops
+        if hops is None and state is not None:
+            hops = state.get('known_good_hops')
+        return hops
+
+    def reset(self):
+        """Forget the routers pinged in the last round, as a new check begins."""
+        self.tier_hops = []
+        self.tier_failure_hop = None
+
+    def probe_tiers(self, state):
+        """
+        Ping the local hops, all at once, before the addresses, and return the
+        hop number of the first that does not answer at all, or None if they
+        all answer.  A dead gateway or first hop means the addresses cannot be
+        reached either, so there is no need to ping them.
+
+        Cached routers answered pings when they were cached, but the gateway
+        has not been checked, and a router may forward traffic while dropping
+        echo requests to itself.  Until the gateway has answered once in this
+        process, its silence is not taken as a failure: a warning is logged,
+        no hops count as pinged, and None is returned, so that the addresses
+        are pinged after all.
+        """
+        self.tier_hops = self.local_hops(state)
+        self.tier_failure_hop = None
+        if not self.tier_hops:
+            return None
+        with self.profiler.phase('probe_tiers', self.prober.name):
+            results = self.prober.probe(self.tier_hops, KNOWN_HOP_PINGS)
+        gateway = None if self.cached_hops(state) else self.tier_hops[0]
+        for hop_num, hop in enumerate(self.tier_hops, start=1):
+            if results[hop]['packet_receive']:
+                continue
+            if gateway is not None and not self.gateway_answered.get(gateway):
+                if gateway not in self.gateway_answered:
+                    self.log.warning(f"Gateway {gateway} has not answered pings yet; it may be "
+                                     f"dropping them, so pinging the addresses instead.")
+                self.gateway_answered[gateway] = False
+                self.tier_hops = []
+                return None
+            self.log.warning(f"Hop {hop_num} ({hop}) is not answering; not pinging the "
+                             f"addresses this round.")
+            self.tier_failure_hop = hop_num
+            return hop_num
+        if gateway is not None:
+            self.gateway_answered[gateway] = True
+        return None
+
+    def failure_hop(self, state):
+        """
+        Return the number of the first hop towards the traceroute address
+        where all probes are unresponsive, or a hop number beyond
+        reboot_hop_threshold once it is known the failure lies past it.
+
+        If the routers for hops 1..reboot_hop_threshold are cached from an
+        earlier traceroute, they are pinged directly, all at once, instead of
+        running a traceroute.  Otherwise a streaming traceroute is run.
+        Returns None if no traceroute address is configured, or in any
+        inconclusive case (error, timeout, or no fully-silent hop found).
+
+        With --tiered, the last round has already pinged the nearest routers.
+        If one of them was down its hop is returned, and if they all answered
+        and cover hops 1..reboot_hop_threshold, the next hop is returned,
+        either way without a traceroute.
+
+        A cached router that does not answer is confirmed with
+        confirm_silent_hop rather than taken as the failure point.
+        """
+        known_good_hops = state.get('known_good_hops') or self.known_good_hops
+        if self.tier_failure_hop is not None:
+            if known_good_hops and self.tier_hops == list(known_good_hops):
+                return self.confirm_silent_hop(self.tier_failure_hop, state)
+            self.log.info(f"Hop {self.tier_failure_hop} did not answer in the last round; "
+                          f"not running traceroute.")
+            return self.tier_failure_hop
+        if len(self.tier_hops) >= self.reboot_hop_threshold:
+            self.log.info("Every router within the reboot threshold answered in the last "
+                          "round; not running traceroute.")
+            return len(self.tier_hops) + 1
+        if self.traceroute_address is None:
+            return None
+        if known_good_hops:
+            return self.probe_known_hops(known_good_hops, state)
+        return self.trace_failure_hop(state)
+
+    def probe_known_hops(self, hops, state):
+        """
+        Ping the cached routers for hops 1..reboot_hop_threshold in parallel
+        and return reboot_hop_threshold + 1 if they all answer.  If one does
+        not answer at all, it is confirmed with confirm_silent_hop.
+        """
+        self.log.info(f"Pinging known-good hops {', '.join(hops)} instead of "
+                      f"running traceroute.")
+        results = probe_aside(self.prober, 'hops', hops, KNOWN_HOP_PINGS)
+        for hop_num, hop in enumerate(hops, start=1):
+            if not results[hop]['packet_receive']:
+                return self.confirm_silent_hop(hop_num, state)
+        self.log.info("All known-good hops within the reboot threshold answered.")
+        return len(hops) + 1
+
+    def confirm_silent_hop(self, hop_num, state):
+        """
+        Handle a cached router that no longer answers pings.  It may only be
+        dropping echo requests, or the route may have changed, so the cache
+        is cleared and the failure hop is found with trace_failure_hop
+        instead, which caches the routers again if they still forward
+        traffic.  Without a traceroute address the hop number is returned.
+        """
+        self.known_good_hops = None
+        state['known_good_hops'] = None
+        if self.traceroute_address is None:
+            return hop_num
+        self.log.warning(f"Known-good hop {hop_num} did not answer pings; forgetting the "
+                         f"known-good hops and confirming with traceroute.")
+        return self.trace_failure_hop(state)
+
+    def cache_known_hops(self, hops, state):
+        """
+        Cache the routers a traceroute found for hops 1..reboot_hop_threshold,
+        for probe_known_hops and --tiered, provided every one of them answers
+        pings.  Many routers send time-exceeded replies, which is how
+        traceroute finds them, but drop echo requests to themselves.
+        """
+        results = probe_aside(self.prober, 'hops', hops, KNOWN_HOP_PINGS)
+        silent = [hop for hop in hops if not results[hop]['packet_receive']]
+        if silent:
+            self.log.info(f"Not caching the known-good hops; {', '.join(silent)} did not "
+                          f"answer pings.")
+            return
+        self.known_good_hops = hops
+        state['known_good_hops'] = hops
+
+    def trace_failure_hop(self, state):
+        """
+        Run traceroute to the configured traceroute address, parsing its
+        output line by line as it arrives.  Tracing stops as soon as the
+        first fully-silent hop is seen, which is returned, or as soon as a
+        hop beyond reboot_hop_threshold answers, since the decision cannot
+        change after either point.  In the latter case the next hop number
+        is returned, and the routers for hops 1..reboot_hop_threshold are
+        cached with cache_known_hops.
+        """
+        command = ['traceroute', '-n', '-m', str(TRACEROUTE_MAX_HOPS), self.traceroute_address]
+        # traceroute block-buffers its output into a pipe; ask for lines.
+        if shutil.which('stdbuf'):
+            command = ['stdbuf', '-oL'] + command
+        try:
+            proc = subprocess.Popen(  # pylint: disable=consider-using-with
+                command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            self.log.warning(f"traceroute to {self.traceroute_address} failed: {e}; "
+                             f"falling back to default reboot behaviour.")
+            return None
+
+        lines = self._stream_lines(proc, time.monotonic() + TRACEROUTE_TIMEOUT)
+        if isinstance(self.prober, RecordingProber):
+            lines = self.prober.record_traceroute(lines)
+        try:
+            return self._follow_trace(lines, state)
+        except subprocess.TimeoutExpired as e:
+            self.log.warning(f"traceroute to {self.traceroute_address} failed: {e}; "
+                             f"falling back to default reboot behaviour.")
+            return None
+        finally:
+            lines.close()
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            proc.stdout.close()
+
+    def _follow_trace(self, lines, state):
+        """
+        Read traceroute output lines until the decision is certain, and return
+        the hop number for trace_failure_hop, or None if the output ends
+        first.
+        """
+        routers = []
+        for line in lines:
+            hop = self._parse_hop_line(line)
+            if hop is None:
+                continue
+            hop_num, responders = hop
+            if responders is None:
+                return hop_num
+            routers.append(responders[0] if responders else None)
+            if hop_num > self.reboot_hop_threshold:
+                self.log.info(f"Traceroute hop {hop_num} answered; the failure is "
+                              f"beyond the reboot threshold.")
+                known_good_hops = routers[:self.reboot_hop_threshold]
+                if len(known_good_hops) == self.reboot_hop_threshold \
+                        and None not in known_good_hops:
+                    self.cache_known_hops(known_good_hops, state)
+                return hop_num + 1
+        return None
+
+    @staticmethod
+    def _stream_lines(proc, deadline):
+        """
+        Yield the lines of a process's stdout as they are written.  Raises
+        subprocess.TimeoutExpired if the deadline passes first.
+        """
+        fd = proc.stdout.fileno()
+        buffer = b''
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(proc.args, TRACEROUTE_TIMEOUT)
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if not readable:
+                continue
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                if buffer:
+                    yield buffer.decode(errors='replace')
+                return
+            *lines, buffer = (buffer + chunk).split(b'\n')
+            for line in lines:
+                yield line.decode(errors='replace')
+
+    @staticmethod
+    def _parse_hop_line(line):
+        """
+        Parse one line of `traceroute -n` output.  Returns (hop number, list
+        of responding addresses in order) for hop lines, with None in place
+        of the list when every probe timed out, or None for any other line.
+        """
+        parts = line.split()
+        if not parts or not parts[0].isdigit():
+            return None
+        responses = parts[1:]
+        if not responses:
+            return None
+        responders = []
+        for token in responses:
+            if token.count('.') == 3 and token not in responders:
+                try:
+                    socket.inet_aton(token)
+                except OSError:
+                    continue
+                responders.append(token)
+        if all(r == '*' for r in responses):
+            return int(parts[0]), None
+        return int(parts[0]), responders
 
-    def get_logger(self):
-        """Build and return the configured logger instance."""
-        logger = logging.getLogger(self.logger_name)
-        logger.setLevel(logging.DEBUG)
-        formatter = logging.Formatter(
-                '%(asctime)s - %(levelname)s-%(name)s-[%(process)d] %(message)s')
-        handler = logging.StreamHandler()
-        handler.setLevel(logging.DEBUG)
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        if self.filename:
-            fhandler = logging.FileHandler(self.filename)
-            fhandler.setFormatter(formatter)
-            logger.addHandler(fhandler)
-        return logger
+    def _parse_first_silent_hop(self, output):
+        """
+        Parse traceroute stdout and return the hop number of the first hop where
+        every probe timed out (i.e. all tokens after the hop number are '*').
+        Returns None if no fully-silent hop is found.
+        """
+        for line in output.splitlines():
+            hop = self._parse_hop_line(line)
+            if hop is not None and hop[1] is None:
+                return hop[0]
+        return None
 
 
 class NetworkMonitor:
     """Monitors internet connectivity by pinging known hosts and acting on
     confirmed failures according to configurable retry and cooldown policies."""
 
-    def __init__(self):
+    def __init__(self, argv=None, prober=None, clock=None):
         self.log = Logger(name="NetworkMonitor").get_logger()
-        self.ping_parse = pingparsing.PingParsing()
-        self.parse_args()
-        try:
-            self.hostname = socket.getfqdn()
-        except OSError:
-            self.log.error("Unable to detect proper hostname")
+        parser, args = self.parse_args(argv)
+        # Every helper runs, so that every invalid value is reported.
+        invalid = [self._use_target_options(args), self._use_probe_options(args),
+                   self._use_degradation_options(args), self._use_outage_options(args),
+                   self._use_daemon_options(args), self._use_logging_options(args),
+                   self._use_diagnostic_options(args)]
+        if any(invalid):
+            parser.print_usage()
             sys.exit(1)
 
         self.keep_testing = 1
         self.failed_ping = []
+        # Failed addresses of each target group, and the groups that were
+        # down, in the last round.
+        self.group_failures = {}
+        self.failed_groups = []
+        # (results, RTTs, duration) of pings sent during the last retry wait
+        # with --retry-watch, used in place of probing for the next round.
+        self.watched_round = None
         self.num_pings = 10
+        # Retry loop of the check in progress, for the structured log.
+        self.loop = 0
+        # Outage state as last loaded or saved, so that a long-running daemon
+        # does not need to re-read the state file on every check.
+        self.state = None
+        # Reboots record their results in the outage state from their own
+        # threads.
+        self.state_lock = threading.Lock()
+        self.profiler = PhaseProfiler(enabled=args.profile or args.profile_trace is not None,
+                                      trace_path=args.profile_trace)
+        # Anything with the time module's time(), monotonic() and sleep(),
+        # such as the VirtualClock used by --replay.
+        self.clock = clock if clock is not None else time
+        # A prober passed in (e.g. network_check_sim.ScriptedProber) replaces
+        # the one selected with --prober.
+        self.prober = prober if prober is not None else self.build_prober(args)
+        if args.record is not None:
+            try:
+                self.prober = RecordingProber(self.prober, args.record, self.log)
+            except OSError as e:
+                self.log.error(f"Could not open recording {args.record}: {e}")
+        self.history = self.open_history(args)
+        self.notifier = self.build_notifier(args)
+        self.hops = self.build_hop_tracker(args)
+        self.reboots = RebootExecutor(self.build_reboot_prober, self.profiler)
+        self.metrics = Metrics(self.notify_cooldown, self.reboot_cooldown, args.metrics_textfile)
+        if args.metrics_port is not None:
+            try:
+                self.metrics.serve(args.metrics_port)
+            except OSError as e:
+                self.log.error(f"Could not serve metrics on port {args.metrics_port}: {e}")
+        self.scheduler = None
+        if args.adaptive_pings:
+            self.scheduler = ProbeScheduler(args.min_pings, args.jitter_threshold, self.history)
+        self.degradation = self.build_degradation_watch(args)
 
         self.store_addresses(self.addresses)
 
-    def parse_args(self):
-        """Parse command-line arguments and store them as instance attributes."""
+    def parse_args(self, argv=None):
+        """
+        Parse command-line arguments (sys.argv unless argv is given), with
+        each feature's options registered by an _add_*_options helper, and
+        return the parser and the arguments.  The matching _use_*_options
+        helpers check them and store those the monitor itself uses as
+        instance attributes; the rest are read by the constructor as it
+        builds the prober, notifier, hop tracker and the other parts.
+        """
         parser = argparse.ArgumentParser(
                 description=("Ping a number of hosts to determine whether "
                              "internet is functional and react accordingly"))
+        for add_options in (self._add_target_options, self._add_email_options,
+                            self._add_probe_options, self._add_degradation_options,
+                            self._add_outage_options, self._add_daemon_options,
+                            self._add_logging_options, self._add_diagnostic_options):
+            add_options(parser)
+        args = parser.parse_args(argv)
+
+        return parser, args
+
+    @staticmethod
+    def _add_target_options(parser):
+        """Register the options choosing the addresses and target groups."""
         parser.add_argument('--addresses',
                             action='store',
                             dest='addresses',
                             type=str,
                             nargs='+',
                             default=['1.1.1.1', '4.2.2.2', '8.8.8.8'],
-                            help="The list of addresses to test")
+                            help=("The list of addresses to test: a.b.c.d to ping, "
+                                  "tcp:a.b.c.d:port to open a TCP connection to, or "
+                                  "dns:a.b.c.d[:port] to send a DNS query to"))
+        parser.add_argument("--groups-file",
+                            dest="groups_file",
+                            default=None,
+                            help=("JSON file of target groups, each with its own addresses, "
+                                  "quorum, loss threshold and exec-on-fail command; "
+                                  "replaces --addresses"))
         parser.add_argument("--exec-on-fail",
                             dest="fail_script",
                             default=None,
                             help=("The command to invoke when there is a "
                                   "confirmed failure"))
+
+    def _use_target_options(self, args):
+        """Check and store the target options."""
+        fail = False
+        groups = self.load_groups(args)
+        if groups is None:
+            groups = []
+            fail = True
+        # Every address is probed once per round however many groups it is in.
+        addresses = list(dict.fromkeys(a for group in groups for a in group.addresses))
+        if not self.verify_target_format(addresses):
+            self.log.error(f"Invalid IP address specified in list ({', '.join(addresses)})")
+            fail = True
+        elif args.prober == PingparsingProber.name and socket_targets(addresses):
+            self.log.error(f"tcp: and dns: targets need the {IcmpProber.name} prober.")
+            fail = True
+        # No validation is performed on fail_script by design — it accepts
+        # arbitrary commands, as documented in README.md.
+        self.groups_file = args.groups_file
+        self.groups = groups
+        self.addresses = addresses
+        return fail
+
+    @staticmethod
+    def _add_email_options(parser):
+        """Register the notification email options."""
         parser.add_argument('--email-recipients',
                             action='store',
                             dest='emails',
@@ -116,6 +2660,15 @@ class NetworkMonitor:
                             type=str,
                             default='localhost',
                             help="The SMTP/MTA to use for sending the email")
+        parser.add_argument('--outbox-dir',
+                            dest='outbox_dir',
+                            default='/var/spool/network_check',
+                            help=("Directory in which outgoing email is spooled until the "
+                                  "relay accepts it"))
+
+    @staticmethod
+    def _add_probe_options(parser):
+        """Register the options controlling probe rounds and retries."""
         parser.add_argument("--retry-count",
                             dest="retry_count",
                             default=2,
@@ -129,6 +2682,140 @@ class NetworkMonitor:
                             type=int,
                             help=("The time to wait in between retries.  Must "
                                   "be a positive integer."))
+        parser.add_argument("--concurrency",
+                            dest="concurrency",
+                            default=8,
+                            type=int,
+                            help=("The maximum number of addresses to ping at "
+                                  "the same time.  Must be a positive integer."))
+        parser.add_argument("--prober",
+                            dest="prober",
+                            choices=['icmp', 'pingparsing'],
+                            default='icmp',
+                            help=("How to send pings.  'icmp' sends them in-process over "
+                                  "a single ICMP socket; 'pingparsing' runs the system ping "
+                                  "command for each address.  Falls back to 'pingparsing' if "
+                                  "no ICMP socket can be opened. (default: icmp)"))
+        parser.add_argument("--probe-rate",
+                            dest="probe_rate",
+                            default=1.0,
+                            type=float,
+                            help="Pings sent to each address per second. (default: 1)")
+        parser.add_argument("--early-decision",
+                            dest="early_decision",
+                            action='store_true',
+                            help=("Stop each round as soon as its outcome is certain "
+                                  "instead of always sending every ping.  Requires the "
+                                  "icmp prober."))
+        parser.add_argument("--retry-watch",
+                            dest="retry_watch",
+                            action='store_true',
+                            help=("Keep pinging every address at a low rate while waiting "
+                                  "to retry, and stop retrying as soon as the link recovers"))
+        parser.add_argument("--retry-watch-interval",
+                            dest="retry_watch_interval",
+                            default=2.0,
+                            type=float,
+                            help=("Seconds between pings to each address with "
+                                  "--retry-watch. (default: 2)"))
+        parser.add_argument("--adaptive-pings",
+                            dest="adaptive_pings",
+                            action='store_true',
+                            help=("Send only --min-pings pings to addresses whose last "
+                                  "round was clean, and the full 10 only once loss or "
+                                  "jitter shows up.  Requires the icmp prober."))
+        parser.add_argument("--min-pings",
+                            dest="min_pings",
+                            default=3,
+                            type=int,
+                            help=("Pings sent to a clean address with --adaptive-pings. "
+                                  "(default: 3)"))
+        parser.add_argument("--jitter-threshold",
+                            dest="jitter_threshold",
+                            default=20.0,
+                            type=float,
+                            help=("RTT variation in milliseconds above which an address "
+                                  "is no longer considered clean with --adaptive-pings, "
+                                  "or degraded with --detect-degradation. (default: 20)"))
+
+    def _use_probe_options(self, args):
+        """
+        Check and store the probe options.  retry_watch_interval is None
+        without --retry-watch.
+        """
+        fail = False
+        if ((args.retry_interval < 0) or (args.retry_count < 0)):
+            self.log.error(f"Invalid retry interval ({args.retry_interval}) or "
+                           f"retry count ({args.retry_count}) requested.")
+            fail = True
+        if args.concurrency < 1:
+            self.log.error(f"Invalid concurrency ({args.concurrency}); must be >= 1.")
+            fail = True
+        if args.probe_rate <= 0:
+            self.log.error(f"Invalid probe rate ({args.probe_rate}); must be > 0.")
+            fail = True
+        if args.min_pings < 1 or args.jitter_threshold < 0:
+            self.log.error(f"Invalid minimum pings ({args.min_pings}) or jitter "
+                           f"threshold ({args.jitter_threshold}) requested.")
+            fail = True
+        if args.retry_watch_interval <= 0:
+            self.log.error(f"Invalid retry watch interval ({args.retry_watch_interval}); "
+                           f"must be > 0.")
+            fail = True
+        self.retry_interval = args.retry_interval
+        self.retry_count = args.retry_count
+        self.concurrency = args.concurrency
+        self.probe_rate = args.probe_rate
+        self.early_decision = args.early_decision
+        self.retry_watch_interval = args.retry_watch_interval if args.retry_watch else None
+        return fail
+
+    @staticmethod
+    def _add_degradation_options(parser):
+        """Register the link degradation options."""
+        parser.add_argument("--detect-degradation",
+                            dest="detect_degradation",
+                            action="store_true",
+                            default=False,
+                            help=("Track loss, RTT and jitter over a rolling window of "
+                                  "rounds and report a degraded link (requires NumPy)"))
+        parser.add_argument("--degradation-window",
+                            dest="degradation_window",
+                            default=30,
+                            type=int,
+                            help="Rounds in the --detect-degradation window. (default: 30)")
+        parser.add_argument("--degraded-loss",
+                            dest="degraded_loss",
+                            default=10.0,
+                            type=float,
+                            help=("Moving-average packet loss (percent) at which an address "
+                                  "is degraded. (default: 10)"))
+        parser.add_argument("--degraded-rtt",
+                            dest="degraded_rtt",
+                            default=150.0,
+                            type=float,
+                            help=("95th percentile RTT in milliseconds at which an address "
+                                  "is degraded. (default: 150)"))
+        parser.add_argument("--notify-degraded",
+                            dest="notify_degraded",
+                            action="store_true",
+                            default=False,
+                            help=("Email the recipients when the link becomes degraded, "
+                                  "at most once per --notify-cooldown"))
+
+    def _use_degradation_options(self, args):
+        """Check the degradation options."""
+        fail = False
+        if (args.degradation_window < 2 or args.degraded_loss <= 0
+                or args.degraded_rtt <= 0):
+            self.log.error(f"Invalid degradation window ({args.degradation_window}), loss "
+                           f"({args.degraded_loss}) or RTT ({args.degraded_rtt}) requested.")
+            fail = True
+        return fail
+
+    @staticmethod
+    def _add_outage_options(parser):
+        """Register the options deciding what is done about an outage."""
         parser.add_argument("--notify-state-file",
                             dest="notify_state_file",
                             default="/var/run/network_check.state",
@@ -140,6 +2827,13 @@ class NetworkMonitor:
                             type=int,
                             help=("Minimum seconds between failure notification "
                                   "emails"))
+        parser.add_argument("--recovery-hold",
+                            dest="recovery_hold",
+                            default=300,
+                            type=int,
+                            help=("Seconds the internet must stay up before the recovery "
+                                  "email is sent; a failure meanwhile continues the outage. "
+                                  "(default: 300)"))
         parser.add_argument("--reboot-cooldown",
                             dest="reboot_cooldown",
                             default=7200,
@@ -160,42 +2854,221 @@ class NetworkMonitor:
                                   "traceroute hop is at or below this value.  A value of 2 "
                                   "means the failure must be at the ISP's first router to "
                                   "justify a reboot. (default: 2)"))
-        args = parser.parse_args()
+        parser.add_argument("--gateway",
+                            dest="gateway",
+                            default=None,
+                            help=("IPv4 address of the modem or router pinged after a reboot "
+                                  "to time how long it takes to come back.  (default: the "
+                                  "default route's gateway from /proc/net/route)"))
+        parser.add_argument("--tiered",
+                            dest="tiered",
+                            action="store_true",
+                            default=False,
+                            help=("Ping the gateway, or the routers cached from an earlier "
+                                  "traceroute, before the addresses each round, skip the "
+                                  "addresses if one of them is down, and base the reboot "
+                                  "decision on which one it is"))
 
-        fail = 0
-        if ((args.retry_interval < 0) or (args.retry_count < 0)):
-            self.log.error(f"Invalid retry interval ({args.retry_interval}) or "
-                           f"retry count ({args.retry_count}) requested.")
-            fail = 1
-        if not self.verify_address_format(args.addresses):
-            self.log.error(f"Invalid IP address specified in list ({', '.join(args.addresses)})")
-            fail = 1
+    def _use_outage_options(self, args):
+        """Check and store the outage options, other than those finding the
+        failure hop, which the HopTracker keeps."""
+        fail = False
         if args.traceroute_address is not None:
             if not self.verify_address_format([args.traceroute_address]):
                 self.log.error(f"Invalid traceroute address: {args.traceroute_address}")
-                fail = 1
+                fail = True
+        if args.gateway is not None and not self.verify_address_format([args.gateway]):
+            self.log.error(f"Invalid gateway address: {args.gateway}")
+            fail = True
+        if args.recovery_hold < 0:
+            self.log.error(f"Invalid recovery hold ({args.recovery_hold}); must be >= 0.")
+            fail = True
         if args.reboot_hop_threshold < 1:
             self.log.error(f"Invalid reboot hop threshold ({args.reboot_hop_threshold}); "
                            f"must be >= 1.")
-            fail = 1
-        # No validation is performed on fail_script by design — it accepts
-        # arbitrary commands, as documented in README.md.
-
-        self.retry_interval = args.retry_interval
-        self.retry_count = args.retry_count
-        self.fail_script = args.fail_script
-        self.addresses = args.addresses
-        self.emails = args.emails
-        self.relay = args.email_relay
+            fail = True
         self.notify_state_file = args.notify_state_file
         self.notify_cooldown = args.notify_cooldown
+        self.recovery_hold = args.recovery_hold
         self.reboot_cooldown = args.reboot_cooldown
-        self.traceroute_address = args.traceroute_address
-        self.reboot_hop_threshold = args.reboot_hop_threshold
+        return fail
 
-        if fail:
-            parser.print_usage()
-            sys.exit(1)
+    @staticmethod
+    def _add_daemon_options(parser):
+        """Register the daemon, probe history and metrics options."""
+        parser.add_argument("--daemon",
+                            dest="daemon",
+                            action='store_true',
+                            help=("Keep running and check connectivity every "
+                                  "--daemon-interval seconds instead of checking once "
+                                  "and exiting"))
+        parser.add_argument("--daemon-interval",
+                            dest="daemon_interval",
+                            default=10,
+                            type=int,
+                            help=("Seconds to wait between checks in daemon mode. "
+                                  "(default: 10)"))
+        parser.add_argument("--history-file",
+                            dest="history_file",
+                            default=None,
+                            help=("Path to a fixed-size, memory-mapped file in which the "
+                                  "results of every probe round are recorded"))
+        parser.add_argument("--history-size",
+                            dest="history_size",
+                            default=65536,
+                            type=int,
+                            help=("Number of per-address records kept in the history file "
+                                  "before the oldest are overwritten. (default: 65536, "
+                                  f"{HISTORY_RECORD.size} bytes each)"))
+        parser.add_argument("--history-query",
+                            dest="history_query",
+                            default=None,
+                            type=int,
+                            metavar="SECONDS",
+                            help=("Print the records from the last SECONDS seconds of "
+                                  "--history-file and exit"))
+        parser.add_argument("--metrics-port",
+                            dest="metrics_port",
+                            default=None,
+                            type=int,
+                            help=("Serve Prometheus metrics over HTTP on this port "
+                                  "(most useful with --daemon)"))
+        parser.add_argument("--metrics-textfile",
+                            dest="metrics_textfile",
+                            default=None,
+                            help=("Write Prometheus metrics to this file after every check, "
+                                  "for node_exporter's textfile collector"))
+
+    def _use_daemon_options(self, args):
+        """Check the daemon, history and metrics options and store those of
+        the daemon and --history-query."""
+        fail = False
+        if args.daemon_interval < 1:
+            self.log.error(f"Invalid daemon interval ({args.daemon_interval}); must be >= 1.")
+            fail = True
+        if args.history_size < 1:
+            self.log.error(f"Invalid history size ({args.history_size}); must be >= 1.")
+            fail = True
+        if args.history_query is not None and args.history_file is None:
+            self.log.error("--history-query requires --history-file.")
+            fail = True
+        self.daemon = args.daemon
+        self.daemon_interval = args.daemon_interval
+        self.history_query = args.history_query
+        return fail
+
+    @staticmethod
+    def _add_logging_options(parser):
+        """Register the log file and format options."""
+        parser.add_argument("--log-file",
+                            dest="log_file",
+                            default=None,
+                            help="Also write the log to this file, rotating it as it grows")
+        parser.add_argument("--log-max-bytes",
+                            dest="log_max_bytes",
+                            default=1048576,
+                            type=int,
+                            help=("Rotate --log-file once it reaches this size; 0 never "
+                                  "rotates it by size. (default: 1048576)"))
+        parser.add_argument("--log-rotate-when",
+                            dest="log_rotate_when",
+                            default=None,
+                            choices=['S', 'M', 'H', 'D', 'midnight'],
+                            help=("Rotate --log-file every second, minute, hour or day, or "
+                                  "at midnight, instead of by size"))
+        parser.add_argument("--log-backups",
+                            dest="log_backups",
+                            default=5,
+                            type=int,
+                            help="Rotated log files kept. (default: 5)")
+        parser.add_argument("--log-format",
+                            dest="log_format",
+                            default='text',
+                            choices=['text', 'json'],
+                            help=("text, or json for one JSON object per line with fixed "
+                                  "fields for machine parsing. (default: text)"))
+
+    def _use_logging_options(self, args):
+        """Check the logging options and, if a log file or JSON lines are
+        asked for, set up the logger again to match."""
+        if args.log_max_bytes < 0 or args.log_backups < 0:
+            self.log.error(f"Invalid log size ({args.log_max_bytes}) or backup count "
+                           f"({args.log_backups}) requested.")
+            return True
+        if args.log_file is not None or args.log_format != 'text':
+            try:
+                self.log = Logger("NetworkMonitor", args.log_file,
+                                  args.log_rotate_when or args.log_max_bytes, args.log_backups,
+                                  json_lines=args.log_format == 'json').get_logger()
+            except OSError as e:
+                self.log.error(f"Could not open log file {args.log_file}: {e}")
+        return False
+
+    @staticmethod
+    def _add_diagnostic_options(parser):
+        """Register the recording, replay and profiling options."""
+        parser.add_argument("--record",
+                            dest="record",
+                            default=None,
+                            metavar="PATH",
+                            help=("Append every probe round and traceroute to PATH, as JSON "
+                                  "lines, for --replay"))
+        parser.add_argument("--replay",
+                            dest="replay",
+                            default=None,
+                            metavar="PATH",
+                            help=("Instead of probing, run checks every --daemon-interval "
+                                  "seconds against a --record recording or --history-file "
+                                  "at PATH on a virtual clock, and report the reboots, "
+                                  "notifications and detection delays of the given policy"))
+        parser.add_argument("--profile",
+                            dest="profile",
+                            action="store_true",
+                            default=False,
+                            help=("Time each phase of the run and print a summary table "
+                                  "on exit"))
+        parser.add_argument("--profile-trace",
+                            dest="profile_trace",
+                            default=None,
+                            metavar="PATH",
+                            help=("Also write every timed phase to PATH as a Chrome trace "
+                                  "JSON file (implies --profile)"))
+
+    def _use_diagnostic_options(self, args):
+        """Check the recording, replay and profiling options."""
+        fail = False
+        if args.record is not None and args.replay is not None:
+            self.log.error("--record and --replay cannot be used together.")
+            fail = True
+        return fail
+
+    def load_groups(self, args):
+        """
+        Return the target groups from --groups-file or, without one, a single
+        group of the --addresses addresses.  Returns None, having logged the
+        problem, if the groups file cannot be used.
+        """
+        if args.groups_file is None:
+            return [TargetGroup(DEFAULT_GROUP, args.addresses, fail_script=args.fail_script)]
+        try:
+            return TargetGroup.load(args.groups_file, args.fail_script)
+        except (OSError, ValueError) as e:
+            self.log.error(f"Invalid groups file {args.groups_file}: {e}")
+            return None
+
+    def verify_target_format(self, addresses):
+        """
+        Make sure every target is an IP address, or a tcp: or dns: target
+        (see parse_target) with a valid IP address
+        """
+        hosts = []
+        for address in addresses:
+            try:
+                hosts.append(parse_target(address)[1])
+            except ValueError as e:
+                self.log.error(str(e))
+                return False
+        return self.verify_address_format(hosts)
 
     def verify_address_format(self, addresses):
         """
@@ -219,8 +3092,22 @@ class NetworkMonitor:
         cooldowns, with state persisted to disk across invocations.
         """
         self.print_stats()
-        now = time.time()
+        now = self.clock.time()
         state = self.load_state()
+        if state.get('recovered_time') is not None:
+            if now - state['recovered_time'] < self.recovery_hold:
+                # Failed again within --recovery-hold of recovering: the
+                # outage carries on under the same cooldowns, and its
+                # recovery notice will cover both.
+                self.log.warning(f"Link failed again {now - state['recovered_time']:.0f} "
+                                 f"seconds after recovering; continuing the same outage.")
+                state['recovered_time'] = None
+                state['flaps'] = state.get('flaps', 0) + 1
+            else:
+                # The link stayed up past the hold, which a oneshot run only
+                # learns now: close the old outage before starting a new one.
+                self._end_outage(state)
+                state = self.load_state()
 
         # Rate-limit reboots.  On the first failure, start the cooldown clock
         # without rebooting so that a single blip never cycles the modem.
@@ -230,35 +3117,29 @@ class NetworkMonitor:
         # first to go silent.  If the failure is beyond the reboot threshold it
         # is upstream of the modem and a reboot won't help.  If the traceroute
         # is inconclusive (error, timeout, or no silent hop found), fall back to
-        # the original behaviour and attempt a reboot.
-        if self.fail_script is not None:
-            first_silent_hop = self.check_failure_hop()
-            if first_silent_hop is not None and first_silent_hop > self.reboot_hop_threshold:
+        # the original behaviour and attempt a reboot.  The check is made once
+        # and applies to every failed target group with a fail script.
+        rebooting = [group for group in self.failed_groups if group.fail_script is not None]
+        if rebooting:
+            hops = self.hops
+            with self.profiler.phase('check_failure_hop', hops.traceroute_address):
+                first_silent_hop = hops.failure_hop(state)
+            if hops.traceroute_address is not None or hops.tier_hops:
+                self.metrics.observe_failure_hop(first_silent_hop)
+            if first_silent_hop is not None and first_silent_hop > hops.reboot_hop_threshold:
                 self.log.warning(
                     f"First unresponsive traceroute hop ({first_silent_hop}) exceeds "
-                    f"reboot threshold ({self.reboot_hop_threshold}). "
+                    f"reboot threshold ({hops.reboot_hop_threshold}). "
                     f"Failure is upstream of the modem; skipping reboot.")
             else:
-                if first_silent_hop is None and self.traceroute_address is not None:
+                if first_silent_hop is None and hops.traceroute_address is not None:
                     self.log.warning("Traceroute inconclusive; defaulting to reboot behaviour.")
                 elif first_silent_hop is not None:
                     self.log.warning(
                         f"First unresponsive traceroute hop ({first_silent_hop}) is within "
-                        f"reboot threshold ({self.reboot_hop_threshold}). Proceeding with reboot.")
-                last_reboot = state['last_reboot_time']
-                if last_reboot is None:
-                    self.log.warning(f"First failure detected. Reboot will trigger "
-                                     f"after cooldown ({self.reboot_cooldown:.0f} seconds).")
-                    state['last_reboot_time'] = now
-                elif (now - last_reboot) >= self.reboot_cooldown:
-                    self.log.info(f"Running {self.fail_script}")
-                    subprocess.call(self.fail_script, shell=True)
-                    state['last_reboot_time'] = now
-                    state['reboot_count'] += 1
-                else:
-                    remaining = self.reboot_cooldown - (now - last_reboot)
-                    self.log.warning(f"Reboot cooldown active. Next reboot "
-                                     f"eligible in {remaining:.0f} seconds.")
+                        f"reboot threshold ({hops.reboot_hop_threshold}). Proceeding with reboot.")
+                for group in rebooting:
+                    self.reboot_if_due(group, state, now)
 
         # Rate-limit failure notifications.
         last_notify = state['last_notify_time']
@@ -271,190 +3152,498 @@ class NetworkMonitor:
                           f"eligible in {remaining:.0f} seconds.")
 
         self.save_state(state)
-        sys.exit(1)
+
+    def reboot_if_due(self, group, state, now):
+        """
+        Run a failed target group's fail script unless its reboot cooldown is
+        still active.  Each group has its own cooldown clock in
+        state['reboot_times']; last_reboot_time is the latest of them.
+        """
+        prefix = '' if self.groups_file is None else f"Group '{group.name}': "
+        reboot_times = state['reboot_times']
+        last_reboot = reboot_times.get(group.name)
+        if last_reboot is None:
+            self.log.warning(f"{prefix}First failure detected. Reboot will trigger "
+                             f"after cooldown ({self.reboot_cooldown:.0f} seconds).")
+            reboot_times[group.name] = now
+        elif self.reboots.busy(group.name):
+            self.log.warning(f"{prefix}The last reboot is still being followed; "
+                             f"not rebooting again.")
+        elif (now - last_reboot) >= self.reboot_cooldown:
+            self.log.info(f"{prefix}Running {group.fail_script}", extra={'phase': 'reboot'})
+            gateway = self.hops.gateway_address()
+            if gateway is None:
+                self.log.warning("No default gateway found; the time until the modem is "
+                                 "up will not be measured.")
+            # The reboot may finish before act_on_failure saves the state, and
+            # records its result only while this is the current outage.
+            with self.state_lock:
+                self.state = state
+            self.reboots.start(group, gateway,
+                               lambda outcome: self.record_reboot(state, outcome))
+            self.metrics.observe_reboot()
+            reboot_times[group.name] = now
+            state['reboot_count'] += 1
+        else:
+            remaining = self.reboot_cooldown - (now - last_reboot)
+            self.log.warning(f"{prefix}Reboot cooldown active. Next reboot "
+                             f"eligible in {remaining:.0f} seconds.")
+        state['last_reboot_time'] = max(t for t in reboot_times.values() if t is not None)
+
+    def build_reboot_prober(self, number):
+        """
+        Return a prober for following the `number`-th reboot, of the same kind
+        as the one in use but with a short timeout and its own socket, so
+        that it can ping alongside the monitor.  A prober passed in to the
+        constructor is shared.  It logs only warnings, so that a ping every
+        REBOOT_PROBE_INTERVAL seconds does not flood the log.
+        """
+        log = logging.getLogger(f"{self.log.name}.reboot")
+        log.setLevel(logging.WARNING)
+        prober = getattr(self.prober, 'prober', self.prober)  # unwrap a RecordingProber
+        if isinstance(prober, IcmpProber):
+            try:
+                return IcmpProber(log, interval=REBOOT_PROBE_INTERVAL,
+                                  timeout=REBOOT_REPLY_TIMEOUT, ident=os.getpid() + number)
+            except OSError as e:
+                self.log.warning(f"Unable to open an ICMP socket to follow the reboot ({e}).")
+        if isinstance(prober, (IcmpProber, PingparsingProber)):
+            return PingparsingProber(log, self.concurrency, interval=REBOOT_PROBE_INTERVAL,
+                                     profiler=self.profiler)
+        return self.prober
+
+    def record_reboot(self, state, outcome):
+        """
+        Log how a reboot turned out and keep the result in the outage state,
+        if that outage is still the current one, for the recovery email.
+        Called on the reboot's thread.
+        """
+        prefix = '' if self.groups_file is None else f"Group '{outcome['group']}': "
+        self.log.info(f"{prefix}{describe_reboot(outcome)}", extra={'phase': 'reboot'})
+        self.metrics.observe_reboot_result(outcome)
+        with self.state_lock:
+            if self.state is not state:
+                return
+            history = state.setdefault('reboot_history', [])
+            history.append(outcome)
+            del history[:-REBOOT_HISTORY_SIZE]
+        self.save_state(state)
+
+    def record_internet_up(self, state, now):
+        """
+        Complete the results of reboots that were still awaiting the internet
+        after REBOOT_TRACK_TIMEOUT.  The last one is taken to have brought the
+        internet back at `now`, which in oneshot mode is only accurate to the
+        timer's interval; any earlier one did not.
+        """
+        with self.state_lock:
+            awaiting = [outcome for outcome in state.get('reboot_history', [])
+                        if outcome['recovered'] is None]
+            for outcome in awaiting:
+                outcome['recovered'] = False
+            if awaiting:
+                last = awaiting[-1]
+                last['recovered'] = True
+                last['internet_up_seconds'] = round(now - last['time'], 1)
+        if awaiting:
+            self.log.info(describe_reboot(last), extra={'phase': 'reboot'})
+            self.metrics.observe_internet_up(last)
+
+    def wait_for_reboots(self, timeout):
+        """Give reboots still being followed up to `timeout` seconds to
+        finish, so that their results are recorded."""
+        if not self.reboots.wait(timeout):
+            self.log.warning(f"A reboot was still being followed after {timeout} seconds.")
 
     def notify_emails(self):
         """
         Send email notice if specified that we have acted on a failure.
         Notification frequency is controlled by the caller via notifyCooldown.
+        If this event triggers, that means internet is considered to be down,
+        so the message may wait in the outbox until it has been restored.
         """
-        if self.emails is None:
-            return
-
-        message = EmailMessage()
-        message.set_content("The Network Monitoring Script has taken action "
-                            "to reboot the modem.  Please review the "
-                            "statistics to verify the results."
-                            "\n\n"
-                            f"Stats: {pprint.pformat(self.address_list)}")
-
-        # Keeping a timestamp in the subject is important since this message
-        # may be getting delivered significantly later than the actual action.
-        # If this event triggers, that means internet is considered to be down.
-        # This message won't be delivered until internet connectivity has been
-        # restored.
-        message['Subject'] = f"[NETWORK FAILURE] {time.strftime('%Y%m%d-%H%M%S')} - {self.hostname}"
-        message['From'] = f"network_check@{self.hostname}"
-        message['To'] = ', '.join(self.emails)
+        groups = ''
+        if self.groups_file is not None:
+            groups = ("Target groups down: "
+                      f"{', '.join(group.name for group in self.failed_groups)}\n\n")
+        self.notifier.send('failure', 'NETWORK FAILURE',
+                           "The Network Monitoring Script has taken action "
+                           "to reboot the modem.  Please review the "
+                           "statistics to verify the results."
+                           "\n\n"
+                           f"{groups}"
+                           f"Stats: {pprint.pformat(self.address_list)}")
 
-        # Now that we're finished assembling the message, let's send it along.
-        smtp = smtplib.SMTP(self.relay)
-        smtp.send_message(message)
-        smtp.quit()
+    def build_notifier(self, args):
+        """Create the notifier for the email options, with its outbox
+        started."""
+        notifier = Notifier(args, self.log, self.profiler)
+        notifier.open_outbox()
+        return notifier
 
     def load_state(self):
         """
-        Load outage state from the state file.  If the file does not exist,
-        a fresh state is returned with first_failure_time set to now.  If the
-        file is unreadable or malformed, a warning is logged and a fresh state
-        is returned.
+        Load outage state, from memory if it has already been loaded or saved
+        by this process, otherwise from the state file.  If the file does not
+        exist, a fresh state is returned with first_failure_time set to now.
+        If the file is unreadable or malformed, a warning is logged and a
+        fresh state is returned.
         """
+        if self.state is not None:
+            return self.state
         if os.path.exists(self.notify_state_file):
             try:
-                with open(self.notify_state_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                with self.profiler.phase('load_state'), \
+                        open(self.notify_state_file, 'r', encoding='utf-8') as f:
+                    self.state = json.load(f)
+                    # State files written before target groups existed only
+                    # have the default group's reboot time.
+                    self.state.setdefault('reboot_times',
+                                          {DEFAULT_GROUP: self.state['last_reboot_time']})
+                    self.state.setdefault('reboot_history', [])
+                    return self.state
             except (OSError, ValueError):
                 self.log.warning(f"Could not read state file {self.notify_state_file}; "
                                  f"starting fresh.")
         return {
-            'first_failure_time': time.time(),
+            'first_failure_time': self.clock.time(),
             'last_reboot_time': None,
+            'reboot_times': {},
             'reboot_count': 0,
+            'reboot_history': [],
             'last_notify_time': None,
+            'recovered_time': None,
+            'flaps': 0,
         }
 
     def save_state(self, state):
         """
         Persist the outage state to disk.
         """
-        try:
-            with open(self.notify_state_file, 'w', encoding='utf-8') as f:
-                json.dump(state, f)
-        except OSError as e:
-            self.log.error(f"Could not write state file {self.notify_state_file}: {e}")
+        with self.state_lock:
+            self.state = state
+            try:
+                with self.profiler.phase('save_state'), \
+                        open(self.notify_state_file, 'w', encoding='utf-8') as f:
+                    json.dump(state, f)
+            except OSError as e:
+                self.log.error(f"Could not write state file {self.notify_state_file}: {e}")
 
     def clear_state(self):
         """
         Remove the state file once internet connectivity has been restored.
         """
+        with self.state_lock:
+            self.state = None
         if os.path.exists(self.notify_state_file):
             try:
                 os.remove(self.notify_state_file)
             except OSError as e:
                 self.log.error(f"Could not remove state file {self.notify_state_file}: {e}")
 
-    def check_failure_hop(self):
+    def build_hop_tracker(self, args):
+        """Create the hop tracker for the --traceroute-address,
+        --reboot-hop-threshold, --gateway and --tiered options."""
+        return HopTracker(args, self.prober, self.log, self.profiler)
+
+    def build_degradation_watch(self, args):
         """
-        Run traceroute to the configured traceroute address and return the first
-        hop number where all probes are unresponsive.  Returns None if no
-        traceroute address is configured, the command fails, times out, or no
-        fully-silent hop is found within the hop limit (all inconclusive cases).
+        Create the rolling-window degradation detector and its watch if
+        --detect-degradation is given.  NumPy is an optional dependency; if
+        it is missing, a warning is logged and detection is disabled.
         """
-        if self.traceroute_address is None:
+        if not args.detect_degradation:
             return None
         try:
-            result = subprocess.run(
-                ['traceroute', '-n', '-m', '10', self.traceroute_address],
-                capture_output=True,
-                text=True,
-                timeout=120,
-                check=False,  # non-zero exit is expected when destination is unreachable
-            )
-            return self._parse_first_silent_hop(result.stdout)
-        except (OSError, subprocess.TimeoutExpired) as e:
-            self.log.warning(f"traceroute to {self.traceroute_address} failed: {e}; "
-                             f"falling back to default reboot behaviour.")
+            detector = DegradationDetector(self.addresses, args.degradation_window,
+                                           self.num_pings, self.history)
+        except ImportError:
+            self.log.warning("NumPy is not installed; --detect-degradation is disabled.")
             return None
+        return DegradationWatch(detector, args, self.log)
 
-    def _parse_first_silent_hop(self, output):
+    def check_degradation(self, connected):
         """
-        Parse traceroute stdout and return the hop number of the first hop where
-        every probe timed out (i.e. all tokens after the hop number are '*').
-        Returns None if no fully-silent hop is found.
+        Analyse the rolling window after a check, raise or clear the degraded
+        state (see DegradationWatch), and notify of a degraded link at most
+        once per --notify-cooldown.  No degraded email is sent while the link
+        is down; the failure email covers that.
         """
-        for line in output.splitlines():
-            parts = line.split()
-            if not parts or not parts[0].isdigit():
-                continue
-            hop_num = int(parts[0])
-            responses = parts[1:]
-            if responses and all(r == '*' for r in responses):
-                return hop_num
-        return None
+        if self.degradation is None:
+            return
+        with self.profiler.phase('degradation'):
+            report, groups = self.degradation.analyse(self.groups)
+        self.metrics.observe_degradation(self.degradation.detector.addresses, report, groups,
+                                         [group.name for group in self.groups])
+
+        now = self.clock.time()
+        state = self.degradation.update(report, groups, now)
+        if state is None:
+            return
+        last_notify = state['last_notify_time']
+        if (self.degradation.notify and connected
+                and (last_notify is None or now - last_notify >= self.notify_cooldown)):
+            self.notify_degradation(state, self.degradation.describe(report))
+            state['last_notify_time'] = now
+        self.degradation.save(state)
+
+    def notify_degradation(self, state, details):
+        """Send an email reporting which groups and addresses are degraded."""
+        since = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state['since']))
+        self.notifier.send('degraded', 'NETWORK DEGRADED',
+                           f"The link from {self.notifier.hostname} is degraded but still up.\n\n"
+                           f"Degraded since: {since}\n"
+                           f"Target groups:  {', '.join(state['groups'])}\n\n"
+                           + '\n'.join(details))
 
     def notify_recovery(self, state):
         """
         Send an email indicating that internet connectivity has been restored,
-        including the outage duration and the number of reboots performed.
+        including the outage duration, how often the link came back and failed
+        again within --recovery-hold, the number of reboots performed and how
+        each of them turned out.
         """
-        if self.emails is None:
-            return
-
-        elapsed = time.time() - state['first_failure_time']
+        elapsed = (state.get('recovered_time') or self.clock.time()) - state['first_failure_time']
         hours, remainder = divmod(int(elapsed), 3600)
         minutes = remainder // 60
-
-        message = EmailMessage()
-        message.set_content(
-            f"Internet connectivity has been restored on {self.hostname}.\n\n"
+        self.notifier.send(
+            'recovery', 'NETWORK RECOVERY',
+            f"Internet connectivity has been restored on {self.notifier.hostname}.\n\n"
             f"Outage duration:            {hours} hour(s) {minutes} minute(s)\n"
-            f"Modem reboots during outage: {state['reboot_count']}")
-        timestamp = time.strftime('%Y%m%d-%H%M%S')
-        message['Subject'] = f"[NETWORK RECOVERY] {timestamp} - {self.hostname}"
-        message['From'] = f"network_check@{self.hostname}"
-        message['To'] = ', '.join(self.emails)
-
-        smtp = smtplib.SMTP(self.relay)
-        smtp.send_message(message)
-        smtp.quit()
+            f"Failures after recovering:  {state.get('flaps', 0)}\n"
+            f"Modem reboots during outage: {state['reboot_count']}"
+            + ''.join(f"\n  {time.strftime('%H:%M:%S', time.localtime(outcome['time']))} "
+                      f"{describe_reboot(outcome)}"
+                      for outcome in state.get('reboot_history', [])))
 
     def run(self):
-        """Run ping tests in a loop until connectivity is confirmed or the retry
-        limit is exceeded, then act on failure or send a recovery notification."""
+        """Check connectivity once, then act on a confirmed failure and exit
+        non-zero, or send a recovery notification if an outage has ended."""
+        connected = self.check_connectivity()
+        self.check_degradation(connected)
+        if not connected:
+            self.act_on_failure()
+            self.wait_for_reboots(REBOOT_TRACK_TIMEOUT + REBOOT_SETTLE_TIMEOUT)
+            self.publish_metrics(False)
+            self.notifier.drain()
+            sys.exit(1)
+        self.check_recovery()
+        self.publish_metrics(True)
+        self.notifier.drain()
+
+    def run_daemon(self):
+        """
+        Keep checking connectivity every daemon_interval seconds, reusing the
+        prober and outage state between checks.  Failures and recoveries are
+        handled exactly as in a single run; the reboot and notification
+        cooldowns keep repeated checks during an outage from over-acting.
+        """
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.log.info(f"Running as a daemon; checking every {self.daemon_interval} seconds.")
+        while True:
+            connected = self.check_connectivity()
+            self.check_degradation(connected)
+            if connected:
+                self.check_recovery()
+                self.publish_metrics(True)
+            else:
+                self.act_on_failure()
+                self.publish_metrics(False)
+            self.clock.sleep(self.daemon_interval)
+
+    def report_profile(self):
+        """Print the --profile summary and write the trace, if requested."""
+        if not self.profiler.enabled:
+            return
+        print(self.profiler.summary())
+        path = self.profiler.trace_path
+        if path is None:
+            return
+        try:
+            self.profiler.write_trace(path)
+        except OSError as e:
+            self.log.error(f"Could not write profile trace {path}: {e}")
+
+    def publish_metrics(self, connected):
+        """Record the outcome of a check and refresh the metrics textfile."""
+        self.metrics.observe_check(connected, self.state)
+        path = self.metrics.textfile
+        if path is None:
+            return
+        try:
+            self.metrics.write_textfile(path)
+        except OSError as e:
+            self.log.error(f"Could not write metrics file {path}: {e}")
+
+    def check_connectivity(self):
+        """Run ping tests in a loop until connectivity is confirmed, returning
+        True, or the retry limit is exceeded, returning False."""
         # Continue to run ping tests until we determine that we're not
         # experiencing an outage
+        self.keep_testing = 1
+        # Pings from the wait after the last round of an earlier check are stale.
+        self.watched_round = None
+        self.hops.reset()
         loop = 0
         while self.keep_testing:
+            self.loop = loop
             # (re)set the faildPing list on each loop since we don't want to
             # keep adding the same hosts every time if they are down.
             self.failed_ping = []
 
-            self.log.info(f"Loop: {loop}, retry count max: {self.retry_count}")
+            self.log.info(f"Loop: {loop}, retry count max: {self.retry_count}",
+                          extra={'loop': loop})
             # Only act on a failure if we've hit the final loop AND we have
             # failures noted from the last round.
             if loop > self.retry_count:
                 self.log.warning(("Maximum Retry count exceeded.  Performing "
                                  "action."))
-                self.act_on_failure()
-                self.keep_testing = 0
-            else:
-                for address, data in self.address_list.items():
-                    self.log.info(f"Checking Address '{address}'")
-                    ping_transmitter = pingparsing.PingTransmitter()
-                    ping_transmitter.destination = address
-                    ping_transmitter.count = self.num_pings
-
-                    ping_results = ping_transmitter.ping()
+                return False
 
-                    result = self.ping_parse.parse(ping_results)
-                    data['Stats'] = result.as_dict()
+            self.probe_addresses()
 
-                loop += 1
+            loop += 1
 
-                # Account for the results from each of the ping tests.
-                self.process_results()
+            # Account for the results from each of the ping tests.
+            self.process_results()
 
-                # Look at the results and sleep if there is any amount of
-                # failure.  Otherwise just return for the next loop.
-                self.sleep_if_failed()
+            # Look at the results and sleep if there is any amount of
+            # failure.  Otherwise just return for the next loop.
+            self.sleep_if_failed()
+        return True
 
-        # If a state file exists, internet has recovered from a prior outage.
-        # Send a recovery notification and clean up the state file.
-        if os.path.exists(self.notify_state_file):
-            state = self.load_state()
+    def check_recovery(self):
+        """
+        If outage state exists, internet has recovered from a prior outage.
+        The outage is held open for --recovery-hold seconds from the first
+        check that found the internet back, so that a link failing again in
+        that time carries on the same outage (see act_on_failure).  Once the
+        hold is over, send a recovery notification and clean up the state.
+        """
+        if self.state is None and not os.path.exists(self.notify_state_file):
+            return
+        state = self.load_state()
+        now = self.clock.time()
+        if state.get('recovered_time') is None:
             self.log.info("Internet connectivity restored after outage.")
-            self.notify_recovery(state)
-            self.clear_state()
+            state['recovered_time'] = now
+            self.record_internet_up(state, now)
+            if self.recovery_hold > 0:
+                self.log.info(f"Holding the recovery notice for {self.recovery_hold} "
+                              f"seconds in case the link fails again.")
+                self.save_state(state)
+        if now - state['recovered_time'] < self.recovery_hold:
+            return
+        self._end_outage(state)
+
+    def _end_outage(self, state):
+        """Send the recovery notification for an outage whose recovery hold
+        is over and clean up the state."""
+        self.wait_for_reboots(REBOOT_SETTLE_TIMEOUT)
+        self.notify_recovery(state)
+        self.clear_state()
+
+    def build_prober(self, args):
+        """
+        Create the prober selected with --prober.  If the in-process ICMP
+        prober cannot open a socket, fall back to the pingparsing prober,
+        unless there are tcp: or dns: targets, which only the ICMP prober can
+        probe.  If every target is a tcp: or dns: target, the ICMP socket is
+        only opened if routers are pinged, with --tiered or on failure.
+        """
+        if args.prober == IcmpProber.name:
+            others = socket_targets(self.addresses)
+            try:
+                return IcmpProber(self.log, interval=1.0 / self.probe_rate,
+                                  icmp=len(others) < len(self.addresses))
+            except OSError as e:
+                if others:
+                    self.log.error(f"Unable to open an ICMP socket ({e}), which the "
+                                   f"{PingparsingProber.name} prober cannot stand in for "
+                                   f"with tcp: and dns: targets.")
+                    sys.exit(1)
+                self.log.warning(f"Unable to open an ICMP socket ({e}); falling back "
+                                 f"to the {PingparsingProber.name} prober.")
+        for option, enabled in (('--early-decision', self.early_decision),
+                                ('--adaptive-pings', args.adaptive_pings)):
+            if enabled:
+                self.log.warning(f"{option} is not supported by the "
+                                 f"{PingparsingProber.name} prober; sending every ping.")
+        return PingparsingProber(self.log, self.concurrency, interval=1.0 / self.probe_rate,
+                                 profiler=self.profiler)
+
+    def open_history(self, args):
+        """
+        Open the probe history file if one is configured.  When only querying,
+        the file is opened at whatever size it already has.  Problems opening
+        it are logged and history recording is disabled.
+        """
+        if args.history_file is None:
+            return None
+        capacity = None if self.history_query is not None else args.history_size
+        try:
+            return ProbeHistory(args.history_file, capacity)
+        except (OSError, ValueError) as e:
+            self.log.error(f"Could not open history file {args.history_file}: {e}")
+            if self.history_query is not None:
+                sys.exit(1)
+            return None
+
+    def print_history(self):
+        """Print the history records from the last history_query seconds."""
+        for record in self.history.query(start=time.time() - self.history_query):
+            stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['time']))
+            print(f"{stamp}  {record['address']:<16} "
+                  f"{record['packet_receive']:>3}/{record['packet_transmit']:<3} "
+                  f"rtt min/avg/max/mdev = {record['rtt_min']}/{record['rtt_avg']}/"
+                  f"{record['rtt_max']}/{record['rtt_mdev']} ms")
+
+    def probe_addresses(self):
+        """
+        Ping every address with the configured prober and store the
+        statistics in each address's data['Stats'].  Both probers work on all
+        addresses at once, so a round takes roughly as long as the slowest
+        host rather than the sum of all of them.
+        """
+        rule = GroupRule([group.rule() for group in self.groups]) if self.early_decision else None
+        if self.watched_round is not None:
+            self.log.info("Deciding this round from the pings sent during the retry wait.")
+            (results, rtts, elapsed), self.watched_round = self.watched_round, None
+            rule = None
+        else:
+            if self.hops.tiered and self.hops.probe_tiers(self.load_state()) is not None:
+                # Nothing is sent to the addresses, which all count as failed.
+                for address, data in self.address_list.items():
+                    data['Stats'] = ProbeTally(address, self.num_pings).as_stats()
+                return
+            start = self.clock.monotonic()
+            with self.profiler.phase('probe_round', self.prober.name):
+                results = self.prober.probe(list(self.address_list), self.num_pings, rule,
+                                            self.scheduler)
+            elapsed = self.clock.monotonic() - start
+            rtts = self.prober.last_rtts
+        for address, stats in results.items():
+            self.address_list[address]['Stats'] = stats
+        self.metrics.observe_round(results, rtts, elapsed)
+        if self.degradation is not None:
+            self.degradation.detector.observe(results, rtts)
+        if self.history is not None:
+            self.history.append_round(self.clock.time(), results)
+        if self.scheduler is not None:
+            self.scheduler.observe(results)
+
+        if rule is not None and rule.decided is not None:
+            planned = self.num_pings * len(results)
+            sent = sum(stats['packet_transmit'] for stats in results.values())
+            # A full round lasts until the last ping has been sent and, if any
+            # host is dropping pings, until that ping has timed out.
+            full_round = (self.num_pings - 1) / self.probe_rate
+            if any(stats['packet_loss_count'] for stats in results.values()):
+                full_round += ICMP_REPLY_TIMEOUT
+            saved = max(0.0, full_round - elapsed)
+            self.log.info(f"Round outcome ({rule.decided}) certain after {elapsed:.1f} "
+                          f"seconds; skipped {planned - sent} of {planned} pings, "
+                          f"saving about {saved:.1f} seconds.")
 
     def store_addresses(self, addresses):
         """
@@ -467,34 +3656,87 @@ class NetworkMonitor:
 
     def process_results(self):
         """
-        Check each destination and determine whether we had more than 50%
-        packet loss.  If so, then add that destination to a list to look at
-        later.
+        Check each destination against the loss threshold (50% by default) of
+        every target group it is in, and decide which groups are down, in a
+        single pass over the round's results.  Failed destinations are added
+        to a list to look at later.
         """
+        stats = {}
         for address, data in self.address_list.items():
             self.log.info(
                 f"{address} - Sent/Received: "
                 f"{data['Stats']['packet_transmit']}/"
-                f"{data['Stats']['packet_receive']}")
+                f"{data['Stats']['packet_receive']}",
+                extra={'address': address, 'sent': data['Stats']['packet_transmit'],
+                       'received': data['Stats']['packet_receive'],
+                       'loss': data['Stats']['packet_loss_rate'],
+                       'rtt': data['Stats']['rtt_avg'], 'loop': self.loop})
+            stats[address] = data['Stats']
 
-            # If any particular host has 50% or more packet loss, then they
-            # should be added to the list of failed pings.
-            if ((data['Stats']['packet_loss_rate'] is None) or
-                    (data['Stats']['packet_loss_rate'] >= 50)):
-                self.log.warning(
-                    f"Packet loss for {address}: "
-                    f"{data['Stats']['packet_loss_rate']}")
-                self.failed_ping.append(address)
+        # If any particular host has at least its group's threshold of packet
+        # loss, then they should be added to the list of failed pings.
+        self.group_failures = {}
+        self.failed_groups = []
+        failed = {}
+        for group in self.groups:
+            group_failed = group.failed_addresses(stats)
+            self.group_failures[group.name] = group_failed
+            if group.is_down(group_failed):
+                self.failed_groups.append(group)
+            failed.update(dict.fromkeys(group_failed))
+        for address in failed:
+            self.log.warning(f"Packet loss for {address}: {stats[address]['packet_loss_rate']}",
+                             extra={'address': address,
+                                    'loss': stats[address]['packet_loss_rate'],
+                                    'loop': self.loop})
+            self.failed_ping.append(address)
+        self.metrics.observe_groups({group.name: group not in self.failed_groups
+                                     for group in self.groups})
 
     def print_stats(self):
         """Print the full address statistics dictionary to stdout."""
         pprint.pprint(self.address_list)
 
+    def watch_retry_wait(self):
+        """
+        Wait out the retry interval while pinging every address once every
+        retry_watch_interval seconds.  Returns True as soon as no target group
+        is down over the last num_pings pings to each address, nor over the
+        last RETRY_WATCH_CONFIRM of them, as the link has recovered and there
+        is no need to retry.  Otherwise, if
+        the wait was long enough for num_pings pings to every address, the
+        latest of them are kept in watched_round to stand in for the next
+        round, which is then decided as soon as the wait ends.
+        """
+        clock = self.clock
+        start = clock.monotonic()
+        deadline = start + self.retry_interval
+        addresses = list(self.address_list)
+        replies = {address: collections.deque(maxlen=self.num_pings) for address in addresses}
+        while clock.monotonic() < deadline:
+            tick = clock.monotonic()
+            probe_aside(self.prober, 'watch', addresses, 1)
+            for address in addresses:
+                replies[address].append((self.prober.last_rtts.get(address) or [None])[0])
+            if all(group.is_up(replies, self.num_pings) for group in self.groups):
+                self.log.info(f"Link recovered {clock.monotonic() - start:.1f} seconds "
+                              f"into the retry wait; not retrying.")
+                return True
+            clock.sleep(max(0.0, min(deadline, tick + self.retry_watch_interval)
+                            - clock.monotonic()))
+        if len(replies[addresses[0]]) == self.num_pings:
+            tallies = {address: ProbeTally.from_replies(address, list(replies[address]))
+                       for address in addresses}
+            self.watched_round = ({address: tally.as_stats() for address, tally in tallies.items()},
+                                  {address: tally.rtts for address, tally in tallies.items()},
+                                  clock.monotonic() - start)
+        return False
+
     def sleep_if_failed(self):
         """
-        Check how many "failed" destinations we have.  If we failed to reach
-        more than half of them for more than half of their packets, then we
-        should consider this a failure and sleep for the set period.
+        Check how many "failed" destinations each target group has.  If any
+        group failed to reach its quorum of destinations (half, by default),
+        then we should consider this a failure and sleep for the set period.
         """
         # If we didn't have any failures added to the list, then we're done.
         if len(self.failed_ping) == 0:
@@ -502,22 +3744,254 @@ class NetworkMonitor:
             self.log.info("No failures to handle, moving along.")
             return
 
-        # Determine whether the number of failed destionations is more than 50%
-        # of our total destinations.  If so, then sleep for the retry Interval
-        # so that we can loop around when we finish.
-        failed_rate = len(self.failed_ping) / len(self.address_list)
-        if failed_rate >= 0.5:
-            self.log.warning(f"Failed host rate ({failed_rate}) matches >=50%. "
-                             f"Retrying in {self.retry_interval} seconds")
-            time.sleep(self.retry_interval)
+        # Report the failed rate of every group that lost any destinations.
+        for group in self.groups:
+            failed_rate = len(self.group_failures[group.name]) / len(group.addresses)
+            if not failed_rate:
+                continue
+            prefix = '' if self.groups_file is None else f"Group '{group.name}': "
+            if group in self.failed_groups:
+                self.log.warning(f"{prefix}Failed host rate ({failed_rate}) "
+                                 f"matches >={group.quorum:.0%}.")
+            else:
+                self.log.info(f"{prefix}Failed host rate ({failed_rate}) < {group.quorum:.0%}.")
+
+        # If any group is down, then sleep for the retry Interval so that we
+        # can loop around when we finish.
+        if self.failed_groups:
+            self.log.warning(f"Retrying in {self.retry_interval} seconds",
+                             extra={'loop': self.loop, 'phase': 'retry_sleep'})
+            with self.profiler.phase('retry_sleep'):
+                if self.retry_watch_interval is None:
+                    self.clock.sleep(self.retry_interval)
+                elif self.watch_retry_wait():
+                    # Recovered while waiting; there is nothing to retry.
+                    self.keep_testing = 0
         else:
-            self.log.info(f"Failed host rate ({failed_rate}) < 50%.  Moving along.")
-            # Clear our Keep Testing flag since we didn't notice more than 50%
-            # of the hosts as being unreachable.
+            self.log.info("Moving along.")
+            # Clear our Keep Testing flag since no group had its quorum of
+            # hosts unreachable.
             self.keep_testing = 0
 
 
+class ReplayReboots:
+    """Stands in for RebootExecutor in --replay, counting reboots instead of
+    running fail scripts."""
+
+    def __init__(self, monitor):
+        self.monitor = monitor
+
+    def busy(self, name):  # pylint: disable=unused-argument
+        """A replayed reboot is over at once."""
+        return False
+
+    def start(self, group, gateway, on_done):  # pylint: disable=unused-argument
+        """Count the reboot."""
+        self.monitor.events.append(('reboot', self.monitor.clock.time(), group.name))
+
+    def wait(self, timeout):  # pylint: disable=unused-argument
+        """There is never a reboot to wait for."""
+        return True
+
+
+class ReplayHopTracker(HopTracker):
+    """Stands in for HopTracker in --replay, finding failure hops in the
+    recorded rounds and traceroutes of a ReplayProber."""
+
+    def cache_known_hops(self, hops, state):
+        """
+        Never cache routers: pings to them are only recorded now and then, so
+        probe_known_hops would replay stale or missing rounds.  Every failure
+        hop comes from a recorded traceroute instead.
+        """
+
+    def local_hops(self, state):
+        """
+        Return the gateway for --tiered if the recording has rounds for it,
+        as one made with --tiered does.  Otherwise return no hops, so that
+        the addresses are always pinged, since a gateway that was never
+        recorded would be replayed as down.
+        """
+        hops = [hop for hop in super().local_hops(state) if hop in self.prober.times]
+        if not hops and self.tiered:
+            self.log.error("The gateway was not recorded; replaying without --tiered.")
+            self.tiered = False
+        return hops
+
+    def trace_failure_hop(self, state):
+        """Follow the traceroute recorded closest before now, if any."""
+        output = self.prober.traceroute_at(self.prober.clock.time())
+        if output is None:
+            self.log.warning("No traceroute recorded near this failure; "
+                             "falling back to default reboot behaviour.")
+            return None
+        return self._follow_trace(output.splitlines(), state)
+
+
+class ReplayMonitor(NetworkMonitor):
+    """
+    Runs the checks of a daemon against a --replay recording instead of the
+    network, to see what a retry, cooldown and threshold policy would have
+    done.  From the first recorded round to the last, check_connectivity()
+    runs every --daemon-interval seconds and is followed by act_on_failure()
+    or check_recovery(), exactly as in run_daemon(), but on a VirtualClock,
+    so that months of recording take seconds.  Nothing leaves the process:
+    fail scripts, notifications and traceroutes are counted or replayed,
+    and the outage state is kept in a temporary directory.  The results are
+    compared with the outages in the recording by report().
+    """
+
+    def __init__(self, argv=None):
+        import tempfile  # pylint: disable=import-outside-toplevel
+        self.events = []
+        self.workdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        super().__init__(argv, clock=VirtualClock())
+        self.notify_state_file = os.path.join(self.workdir.name, 'state')
+        self.reboots = ReplayReboots(self)
+        # Logging every replayed check would cost more than the check itself
+        # and bury the report.
+        self.log.setLevel(logging.ERROR)
+
+    def build_prober(self, args):
+        """Answer every probe from the recording."""
+        try:
+            return ReplayProber(args.replay, self.clock, interval=1.0 / self.probe_rate)
+        except (OSError, ValueError) as e:
+            self.log.error(f"Could not read recording {args.replay}: {e}")
+            sys.exit(1)
+
+    def open_history(self, args):
+        """Replayed rounds are not added to a history file."""
+        return None
+
+    def build_notifier(self, args):
+        """Notifications are counted rather than sent, so no outbox is
+        started."""
+        return Notifier(args, self.log, self.profiler)
+
+    def build_hop_tracker(self, args):
+        """Take failure hops from the recording."""
+        return ReplayHopTracker(args, self.prober, self.log, self.profiler)
+
+    def print_stats(self):
+        """Statistics are not printed for every replayed failure."""
+
+    def notify_emails(self):
+        """Count a failure notification."""
+        self.events.append(('notify', self.clock.time(), None))
+
+    def notify_recovery(self, state):
+        """Count a recovery notification."""
+        self.events.append(('recovery', self.clock.time(), None))
+
+    def outages(self):
+        """
+        Return (start, end) of every outage in the recording: a span of
+        recorded rounds in which some target group was down judged on that
+        round alone, or, with --tiered, the gateway did not answer, in which
+        case the addresses were not probed.  An outage still going at the end
+        of the recording ends at its last round.
+        """
+        hops = self.hops.local_hops(None) if self.hops.tiered else []
+        times = sorted({timestamp for address in self.addresses + hops
+                        for timestamp in self.prober.times.get(address, ())})
+        outages = []
+        start = None
+        for timestamp in times:
+            results = {address: self.prober.probe_at(address, timestamp)
+                       for address in self.addresses}
+            down = any(group.is_down(group.failed_addresses(results)) for group in self.groups) \
+                or any(not self.prober.probe_at(hop, timestamp)['packet_receive'] for hop in hops)
+            if down and start is None:
+                start = timestamp
+            elif not down and start is not None:
+                outages.append((start, timestamp))
+                start = None
+        if start is not None:
+            outages.append((start, times[-1]))
+        return outages
+
+    def run_replay(self):
+        """Replay the whole recording and print the report."""
+        started = time.perf_counter()
+        first, last = self.prober.span()
+        self.clock.now = first
+        checks = 0
+        while self.clock.time() <= last:
+            checks += 1
+            if self.check_connectivity():
+                self.check_recovery()
+            else:
+                self.events.append(('failure', self.clock.time(), None))
+                self.act_on_failure()
+            self.clock.sleep(self.daemon_interval)
+        print(self.report(checks, time.perf_counter() - started))
+
+    @staticmethod
+    def detection_delays(outages, failures):
+        """
+        Return how long after it began each outage was first seen by a failed
+        check, for the outages that were, and how many failed checks came
+        before any outage began.  An outage is seen by the first failed check
+        after it began and before the next one did.
+        """
+        delays = []
+        starts = [start for start, _ in outages] + [math.inf]
+        for start, following in zip(starts, starts[1:]):
+            seen = [failure for failure in failures if start <= failure < following]
+            if seen:
+                delays.append(seen[0] - start)
+        early = sum(1 for failure in failures if failure < starts[0])
+        return delays, early
+
+    def report(self, checks, elapsed):
+        """Return a summary of what the policy did during the recording."""
+        first, last = self.prober.span()
+        outages = self.outages()
+        failures = [event[1] for event in self.events if event[0] == 'failure']
+        delays, early = self.detection_delays(outages, failures)
+        counts = collections.Counter(event[0] for event in self.events)
+        lines = [
+            f"Replayed {(last - first) / 86400:.1f} days ({checks} checks every "
+            f"{self.daemon_interval} seconds) in {elapsed:.1f} seconds",
+            f"Policy: --retry-count {self.retry_count} --retry-interval {self.retry_interval} "
+            f"--notify-cooldown {self.notify_cooldown} --recovery-hold {self.recovery_hold} "
+            f"--reboot-cooldown {self.reboot_cooldown} "
+            f"--reboot-hop-threshold {self.hops.reboot_hop_threshold}",
+            f"Outages in the recording:   {len(outages)}",
+            f"Outages detected:           {len(delays)}",
+            f"Failed checks:              {len(failures)} ({early} before any outage)",
+            f"Reboots:                    {counts['reboot']}",
+            f"Failure notifications:      {counts['notify']}",
+            f"Recovery notifications:     {counts['recovery']}",
+        ]
+        if delays:
+            delays.sort()
+            lines.append(f"Detection delay (seconds): min {delays[0]:.0f}, "
+                         f"median {delays[len(delays) // 2]:.0f}, max {delays[-1]:.0f}")
+        return '\n'.join(lines)
+
+
+def replay_requested(argv):
+    """Return True if the arguments ask for --replay, which needs a
+    ReplayMonitor rather than a NetworkMonitor."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--replay')
+    return parser.parse_known_args(argv)[0].replay is not None
+
+
 if __name__ == "__main__":
+    if replay_requested(sys.argv[1:]):
+        ReplayMonitor().run_replay()
+        sys.exit(0)
     NM = NetworkMonitor()
-    NM.run()
+    if NM.history_query is not None:
+        NM.print_history()
+        sys.exit(0)
+    try:
+        if NM.daemon:
+            NM.run_daemon()
+        NM.run()
+    finally:
+        NM.report_profile()
     sys.exit(0)
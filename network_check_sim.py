@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+"""
+Fake backends for exercising network_check.py without a network.
+
+ScriptedProber stands in for the ICMP and pingparsing probers and reports
+whatever loss and RTT it has been told to for each address.
+traceroute_output() produces canned `traceroute -n` output for
+HopTracker._parse_first_silent_hop, and install_fake_traceroute() puts a
+`traceroute` on PATH that prints it, for HopTracker.trace_failure_hop.
+SmtpSink is an SMTP server, run on a thread in the calling process, that
+keeps every message it is sent.  TcpService and DnsResponder are local
+stand-ins for the services behind tcp: and dns: targets, for the real
+IcmpProber to probe.
+
+None of this is installed; it is used by bench_sim.py and check_sim.py and
+can be imported from a Python shell in the source directory:
+
+  import network_check, network_check_sim
+  prober = network_check_sim.ScriptedProber()
+  nm = network_check.NetworkMonitor(['--addresses', '10.0.0.1'], prober=prober)
+  prober.set_all(loss=1.0)
+  nm.check_connectivity()
+"""
+
+import email
+import email.policy
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+from network_check import TRACEROUTE_MAX_HOPS, ProbeTally
+
+
+class ScriptedProber:
+    """
+    Prober that reports scripted results instead of sending anything.
+
+    Each address is given a loss fraction (0.0 to 1.0) and an RTT in
+    milliseconds with set() or set_all(); unscripted addresses use the
+    defaults.  Losses are spread evenly over a round, so the same script
+    always gives the same statistics.  round_time seconds are slept per
+    probe() call to stand in for the time a real round takes.
+    """
+
+    name = 'scripted'
+
+    def __init__(self, loss=0.0, rtt=10.0, jitter=0.0, round_time=0.0):
+        self.default = (loss, rtt, jitter)
+        self.script = {}
+        self.round_time = round_time
+        self.rounds = 0
+        self.last_rtts = {}
+
+    def set(self, address, loss=0.0, rtt=10.0, jitter=0.0):
+        """Script the loss fraction, RTT and RTT jitter (ms) of one address."""
+        self.script[address] = (loss, rtt, jitter)
+
+    def set_all(self, loss=0.0, rtt=10.0, jitter=0.0):
+        """Script every address, discarding any per-address settings."""
+        self.default = (loss, rtt, jitter)
+        self.script = {}
+
+    def probe(self, addresses, count, rule=None, scheduler=None):  # pylint: disable=unused-argument
+        """
+        Return {address: stats} for a round of `count` pings to each address,
+        in the same shape as the real probers.  Rounds always run to the end,
+        so a QuorumRule or ProbeScheduler is ignored.
+        """
+        if self.round_time:
+            time.sleep(self.round_time)
+        self.rounds += 1
+        results = {}
+        self.last_rtts = {}
+        for address in addresses:
+            loss, rtt, jitter = self.script.get(address, self.default)
+            tally = ProbeTally(address, count)
+            tally.sent = count
+            lost = round(count * loss)
+            for seq in range(count):
+                # Bresenham-style spread: request seq is lost when the running
+                # share of losses crosses a whole number.
+                if (seq + 1) * lost // count != seq * lost // count:
+                    tally.add_loss()
+                else:
+                    tally.add_reply(rtt + jitter * (1 if seq % 2 else -1))
+            results[address] = tally.as_stats()
+            self.last_rtts[address] = list(tally.rtts)
+        return results
+
+
+def traceroute_output(destination, routers, silent_from=None, max_hops=TRACEROUTE_MAX_HOPS):
+    """
+    Return the output of `traceroute -n destination` along a path through
+    `routers`, one address per hop.  Every hop from silent_from on is all
+    '*'; otherwise the trace ends at the last router.
+    """
+    lines = [f"traceroute to {destination} ({destination}), {max_hops} hops max, "
+             f"60 byte packets"]
+    last_hop = len(routers) if silent_from is None else max_hops
+    for hop in range(1, last_hop + 1):
+        if (silent_from is not None and hop >= silent_from) or hop > len(routers):
+            lines.append(f"{hop:2d}  * * *")
+        else:
+            rtt = 0.4 * hop
+            lines.append(f"{hop:2d}  {routers[hop - 1]}  {rtt:.3f} ms  {rtt + 0.021:.3f} ms  "
+                         f"{rtt + 0.013:.3f} ms")
+    return '\n'.join(lines) + '\n'
+
+
+def install_fake_traceroute(directory, output, line_delay=0.0):
+    """
+    Write an executable `traceroute` into directory that ignores its
+    arguments and prints `output`, pausing line_delay seconds before each
+    line as a real traceroute does while waiting on a hop.  Put directory
+    first on PATH to have NetworkMonitor run it.  Returns its path.
+    """
+    path = os.path.join(directory, 'traceroute')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f"#!{sys.executable}\n"
+                f"import sys, time\n"
+                f"for line in {output.splitlines()!r}:\n"
+                f"    time.sleep({line_delay!r})\n"
+                f"    print(line, flush=True)\n")
+    os.chmod(path, 0o755)
+    return path
+
+
+class SmtpSink:
+    """
+    Minimal SMTP server on 127.0.0.1 that accepts every message and keeps
+    it, with the time.monotonic() time it arrived, in `messages`.  Pass
+    `relay` as --email-relay.  Usable as a context manager.
+    """
+
+    def __init__(self, port=0):
+        self.messages = []
+        self.received = threading.Condition()
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            """Speaks just enough SMTP for smtplib.send_message()."""
+
+            def reply(self, line):
+                """Send one response line."""
+                self.wfile.write(line.encode('ascii') + b'\r\n')
+
+            def handle(self):
+                self.reply('220 network_check_sim ESMTP')
+                data = None
+                for raw in self.rfile:
+                    if data is not None:
+                        if raw.rstrip(b'\r\n') == b'.':
+                            sink.deliver(b''.join(data))
+                            data = None
+                            self.reply('250 OK')
+                        else:
+                            data.append(raw[1:] if raw.startswith(b'..') else raw)
+                        continue
+                    verb = raw.split(b' ', 1)[0].strip().upper()
+                    if verb == b'DATA':
+                        data = []
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                    elif verb == b'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        # EHLO, HELO, MAIL, RCPT, RSET and NOOP all succeed.
+                        self.reply('250 OK')
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.relay = f"127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, name="smtp-sink",
+                         daemon=True).start()
+
+    def deliver(self, raw):
+        """Parse and keep one message received by the server."""
+        message = email.message_from_bytes(raw, policy=email.policy.default)
+        with self.received:
+            self.messages.append((time.monotonic(), message))
+            self.received.notify_all()
+
+    def wait_for(self, count, timeout):
+        """Wait until at least `count` messages have arrived.  Returns True
+        if they did before the timeout."""
+        with self.received:
+            return self.received.wait_for(lambda: len(self.messages) >= count, timeout)
+
+    def close(self):
+        """Stop the server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TcpService:
+    """
+    TCP listener on 127.0.0.1 that accepts connections and closes them at
+    once.  Pass `target` as a tcp: address.  While `answering` is False the
+    listening socket is closed, so that connections are refused.  Usable as
+    a context manager.
+    """
+
+    def __init__(self, port=0):
+        self.port = port
+        self.sock = None
+        self.accepted = 0
+        self.start()
+        self.target = f"tcp:127.0.0.1:{self.port}"
+
+    def start(self):
+        """Start listening (again) on the same port."""
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', self.port))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        self.answering = True
+        threading.Thread(target=self._accept, args=(self.sock,), name="tcp-service",
+                         daemon=True).start()
+
+    def _accept(self, sock):
+        """Accept and drop connections until the socket is closed."""
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return
+            self.accepted += 1
+            conn.close()
+
+    def close(self):
+        """Stop listening, so that connections are refused."""
+        self.answering = False
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.answering:
+            self.close()
+
+
+class DnsResponder:
+    """
+    DNS server on 127.0.0.1 that answers every query with an empty response
+    after `delay` seconds.  Pass `target` as a dns: address.  While
+    `answering` is False, queries are read and ignored, and while `wrong_id`
+    is True, responses carry an identifier other than the query's.  Usable
+    as a context manager.
+    """
+
+    def __init__(self, port=0, delay=0.0):
+        self.delay = delay
+        self.answering = True
+        self.wrong_id = False
+        self.queries = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', port))
+        self.target = f"dns:127.0.0.1:{self.sock.getsockname()[1]}"
+        threading.Thread(target=self._serve, name="dns-responder", daemon=True).start()
+
+    def _serve(self):
+        """Answer queries until the socket is closed."""
+        while True:
+            try:
+                query, peer = self.sock.recvfrom(512)
+            except OSError:
+                return
+            self.queries += 1
+            if not self.answering or len(query) < 12:
+                continue
+            if self.delay:
+                time.sleep(self.delay)
+            # Same identifier and question, with QR set and no answers.
+            query_id, flags = struct.unpack('!HH', query[:4])
+            if self.wrong_id:
+                query_id ^= 0xffff
+            header = struct.pack('!HHHHHH', query_id, flags | 0x8080, 1, 0, 0, 0)
+            try:
+                self.sock.sendto(header + query[12:], peer)
+            except OSError:
+                return
+
+    def close(self):
+        """Stop the server."""
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()